@@ -0,0 +1,271 @@
+"""Micro-benchmarks of Python - SWI-Prolog bridge (swipl.py). Run:
+	python -m plbench [-n NUMBER] [-r REPEAT] [-k PATTERN] [-o FILE]
+Result is JSON: environment and, for each benchmark, number of operations,
+best time of repeats and microseconds per operation. Compare results of
+releases to catch regressions in hot paths
+"""
+import sys
+import array
+import json
+import platform
+from optparse import OptionParser
+
+import swipl
+from plutils import _clock
+
+#------------------------------ Benchmarks ---------------------------------
+# Each benchmark is function( eng, n ) which does n operations (n is
+# scaled by --number) and returns number of done operations and seconds
+# of measured loop (setup is not measured) by _clock (perf_counter if it
+# exists: _clock() is too coarse for microseconds per operation)
+
+def bench_caller_attr( eng, n ):
+	"""DLL function called via Caller attribute (bound function)"""
+	new_term_ref = eng.pl.PL_new_term_ref
+	with eng.frame():
+		start = _clock()
+		for i in range( n ):
+			new_term_ref()
+		return n, _clock() - start
+
+def bench_caller_getattr( eng, n ):
+	"""First call of DLL function on lazy Caller (prototype compiling
+	and binding by __getattr__())"""
+	utils = [swipl.PlUtils( eng.dll ) for i in range( n )]
+	with eng.frame():
+		start = _clock()
+		for pl in utils:
+			pl.PL_new_term_ref()
+		return n, _clock() - start
+
+def bench_caller_adhoc( eng, n ):
+	"""DLL function with ad-hoc prototype ('fun:proto' call)"""
+	pl = eng.pl
+	with eng.frame():
+		start = _clock()
+		for i in range( n ):
+			pl( 'PL_new_term_ref:->term_t' )()
+		return n, _clock() - start
+
+def _bench_put( obj ):
+	def bench( eng, n ):
+		put_term = eng.put_term
+		with eng.frame():
+			t = eng.pl.PL_new_term_ref()
+			start = _clock()
+			for i in range( n ):
+				put_term( t, obj )
+			return n, _clock() - start
+	bench.__doc__ = 'PlEngine.put_term() of %s'%type( obj ).__name__
+	return bench
+
+def _bench_term_put( make, what ):
+	"""make( eng ) returns object to put (PlAtom needs engine)"""
+	def bench( eng, n ):
+		obj = make( eng )
+		with eng.frame():
+			t = eng.Term()
+			start = _clock()
+			for i in range( n ):
+				t.put( obj )
+			return n, _clock() - start
+	bench.__doc__ = 'PlTerm.put() of %s'%what
+	return bench
+
+def bench_atom_new( eng, n ):
+	"""PlAtom creation (PL_new_atom() and PL_unregister_atom())"""
+	Atom = eng.Atom
+	start = _clock()
+	for i in range( n ):
+		Atom( 'bench_atom' )
+	return n, _clock() - start
+
+def bench_atom_interned( eng, n ):
+	"""Atom from atoms table"""
+	atoms = eng.atoms
+	start = _clock()
+	for i in range( n ):
+		atoms['bench_atom']
+	return n, _clock() - start
+
+def _nested( size ):
+	"""Nested data of size items"""
+	return [('item', i, float( i ), 'name%d'%(i%10), [i, i+1]) for i in range( size )]
+
+def _bench_build( size ):
+	def bench( eng, n ):
+		data = _nested( size )
+		put_term = eng.put_term
+		with eng.frame() as f:
+			t = eng.pl.PL_new_term_ref()
+			start = _clock()
+			for i in range( n ):
+				put_term( t, data )
+				f.rewind()
+			return n*size, _clock() - start
+	bench.__doc__ = 'Build list of %d compounds (per item)'%size
+	return bench
+
+def _bench_decode( size ):
+	def bench( eng, n ):
+		data = _nested( size )
+		with eng.frame():
+			t = eng.to_term( data )
+			decode = eng.pl.decoder().decode
+			start = _clock()
+			for i in range( n ):
+				decode( t.pl_term )
+			return n*size, _clock() - start
+	bench.__doc__ = 'Decode list of %d compounds (per item)'%size
+	return bench
+
+def _bench_array( size, via_file, put ):
+	def bench( eng, n ):
+		data = array.array( 'd', range( size ) )
+		with eng.frame():
+			t = eng.pl.PL_new_term_ref()
+			eng.put_array( t, data )
+			start = _clock()
+			for i in range( n ):
+				if put:
+					eng.put_array( t, data, via_file=via_file )
+				else:
+					eng.get_array( t, via_file=via_file )
+			return n*size, _clock() - start
+	bench.__doc__ = '%s of %d floats%s (per item)'%(
+		'put_array()' if put else 'get_array()', size,
+		' via file' if via_file else '' )
+	return bench
+
+def bench_query_latency( eng, n ):
+	"""Open, next and close of query true/0"""
+	query = eng.query
+	start = _clock()
+	for i in range( n ):
+		for t in query( 'true' ):
+			pass
+	return n, _clock() - start
+
+def bench_prepared_latency( eng, n ):
+	"""Call of prepared goal atom(?)"""
+	goal = eng.prepare( 'atom(?)' )
+	start = _clock()
+	for i in range( n ):
+		for t in goal( 'a' ):
+			pass
+	return n, _clock() - start
+
+def bench_streaming( eng, n ):
+	"""Solutions of between/3 (per solution)"""
+	start = _clock()
+	for t in eng.query( 'between', 1, n, None ):
+		pass
+	return n, _clock() - start
+
+def bench_streaming_decode( eng, n ):
+	"""Decoded solutions of between/3 (per solution)"""
+	start = _clock()
+	for t in eng.query( 'between', 1, n, None, decode=True ):
+		pass
+	return n, _clock() - start
+
+def bench_streaming_batch( eng, n ):
+	"""Solutions of between/3 fetched by batches (per solution)"""
+	start = _clock()
+	for t in eng.query( 'between', 1, n, None, batch=1000 ):
+		pass
+	return n, _clock() - start
+
+# (name, function, base number of operations)
+BENCHMARKS = [
+	('caller.attr', bench_caller_attr, 100000),
+	('caller.getattr', bench_caller_getattr, 10000),
+	('caller.adhoc', bench_caller_adhoc, 100000),
+	('put.none', _bench_put( None ), 100000),
+	('put.int', _bench_put( 12345 ), 100000),
+	('put.bigint', _bench_put( 2**100 ), 10000),
+	('put.float', _bench_put( 1.5 ), 100000),
+	('put.str', _bench_put( 'atom' ), 100000),
+	('put.unicode', _bench_put( u'\u0430\u0442\u043e\u043c' ), 100000),
+	('put.list', _bench_put( [1, 2, 3, 4, 5] ), 20000),
+	('put.tuple', _bench_put( ('f', 1, 'a', 2.0) ), 20000),
+	('put.bytes', _bench_put( bytearray( 1024 ) ), 20000),
+	('term.put.none', _bench_term_put( lambda eng: None, 'None' ), 100000),
+	('term.put.int', _bench_term_put( lambda eng: 12345, 'int' ), 100000),
+	('term.put.float', _bench_term_put( lambda eng: 1.5, 'float' ), 100000),
+	('term.put.str', _bench_term_put( lambda eng: 'string', 'str' ), 100000),
+	('term.put.bytes', _bench_term_put( lambda eng: bytearray( 1024 ),
+		'bytearray' ), 20000),
+	('term.put.chars', _bench_term_put( lambda eng: ['a', 'b', 'c'],
+		'list (chars)' ), 20000),
+	('term.put.atom', _bench_term_put( lambda eng: eng.Atom( 'atom' ),
+		'PlAtom' ), 100000),
+	('atom.new', bench_atom_new, 20000),
+	('atom.interned', bench_atom_interned, 100000),
+	('build.10', _bench_build( 10 ), 2000),
+	('build.1000', _bench_build( 1000 ), 20),
+	('build.100000', _bench_build( 100000 ), 1),
+	('decode.10', _bench_decode( 10 ), 2000),
+	('decode.1000', _bench_decode( 1000 ), 20),
+	('decode.100000', _bench_decode( 100000 ), 1),
+	('array.put.100000', _bench_array( 100000, False, True ), 5),
+	('array.put_file.100000', _bench_array( 100000, True, True ), 5),
+	('array.get.100000', _bench_array( 100000, False, False ), 5),
+	('array.get_file.100000', _bench_array( 100000, True, False ), 5),
+	('array.put.1000000', _bench_array( 1000000, False, True ), 1),
+	('array.put_file.1000000', _bench_array( 1000000, True, True ), 1),
+	('array.get.1000000', _bench_array( 1000000, False, False ), 1),
+	('array.get_file.1000000', _bench_array( 1000000, True, False ), 1),
+	('query.latency', bench_query_latency, 20000),
+	('query.prepared', bench_prepared_latency, 20000),
+	('query.stream', bench_streaming, 200000),
+	('query.stream_decode', bench_streaming_decode, 200000),
+	('query.stream_batch', bench_streaming_batch, 200000),
+	]
+
+#------------------------------ Runner -------------------------------------
+def run( eng, number=1.0, repeat=3, pattern=None ):
+	"""Run benchmarks which names contain pattern (all if None). Base
+	numbers of operations are multiplied by number. Return list of
+	results (dictionaries), time of each is best of repeat runs"""
+	results = []
+	for name, bench, base in BENCHMARKS:
+		if pattern and pattern not in name:
+			continue
+		n = max( 1, int( base*number ) )
+		best = None
+		for r in range( repeat ):
+			ops, seconds = bench( eng, n )
+			if best is None or seconds < best:
+				best = seconds
+		results.append( dict( name=name, doc=bench.__doc__, ops=ops,
+			seconds=best, usec_per_op=1e6*best/ops if ops else None ) )
+	return results
+
+def main( argv=None ):
+	parser = OptionParser( usage='python -m plbench [options]' )
+	parser.add_option( '-n', '--number', type='float', default=1.0,
+		help='scale of operations number (default 1.0)' )
+	parser.add_option( '-r', '--repeat', type='int', default=3,
+		help='repeats of each benchmark, best is reported (default 3)' )
+	parser.add_option( '-k', dest='pattern',
+		help='run only benchmarks which names contain PATTERN' )
+	parser.add_option( '-o', '--output', help='write JSON into file' )
+	opts, args = parser.parse_args( argv )
+	eng = swipl.PlEngine( *args )
+	report = dict(
+		python=sys.version.split()[0],
+		platform=platform.platform(),
+		swipl_version=eng.version,
+		init_times=eng.init_times,
+		results=run( eng, opts.number, opts.repeat, opts.pattern ) )
+	text = json.dumps( report, indent=1, sort_keys=True )
+	if opts.output:
+		with open( opts.output, 'w' ) as f:
+			f.write( text + '\n' )
+	else:
+		print( text )
+	return 0
+
+if __name__ == '__main__':
+	sys.exit( main() )
@@ -2,6 +2,10 @@
 """
 from warnings import warn
 import ctypes
+import time
+
+# the best clock for short intervals
+_clock = getattr( time, 'perf_counter', time.time )
 
 class Caller:
 	"""Utilitary functions. Alternative way to call any functions
@@ -9,13 +13,18 @@ class Caller:
 	Arguments are Prolog engine internal data types (like
 	term_t, atom_t in SWI-Prolog)
 	"""
-	def __init__( self, dll, types_table={}, proto_table={}, verbose=False ):
+	def __init__( self, dll, types_table={}, proto_table={}, verbose=False, eager=False,
+			profile=False, sample=1.0 ):
 		"""dll is some loaded DLL by ctypes.
 		types_table is map like:
 		{'xxx_t':POINTER(c_uint), ...}.
 		proto_table is map like:
 		{'fun1':'int,int->int', ...}.
-		If verbose==True when call without prototype will warning
+		If verbose==True when call without prototype will warning.
+		If eager==True all functions of proto_table are bound
+		at once (see bind()), otherwise each function is bound on
+		its first use.
+		If profile==True calls are counted and timed, see profile()
 		"""
 		_TYPE_CONS = {
 		'char':ctypes.c_char,
@@ -31,12 +40,22 @@ class Caller:
 		'int64':ctypes.c_longlong,
 		'ulonglong':ctypes.c_ulonglong, # for uint64 too
 		'uint64':ctypes.c_ulonglong,
+		'size_t':ctypes.c_size_t,
 		'float':ctypes.c_float,
 		'double':ctypes.c_double,
 		'void_p':ctypes.c_void_p,
 		'char_p':ctypes.c_char_p,
 		'int_p':ctypes.POINTER(ctypes.c_int),
 		'uint_p':ctypes.POINTER(ctypes.c_uint),
+		# ctypes-like aliases (as in 'c_int,char_p->atom_t')
+		'c_int':ctypes.c_int,
+		'c_uint':ctypes.c_uint,
+		'c_long':ctypes.c_long,
+		'c_double':ctypes.c_double,
+		'c_void_p':ctypes.c_void_p,
+		'c_char_p':ctypes.c_char_p,
+		'c_wchar_p':ctypes.c_wchar_p,
+		'c_int_p':ctypes.POINTER(ctypes.c_int),
 		}
 
 		self.types_table = _TYPE_CONS
@@ -45,12 +64,42 @@ class Caller:
 		self.proto_table = {}
 		self.proto_table.update( proto_table )
 		self.dll = dll # ctype DLL
+		# compiled functions: name -> ctypes function object (from
+		# proto_table) and 'fun:proto' -> ctypes function object (ad-hoc)
+		self.__funs = {}
+		self.__adhoc_funs = {}
+		self.__eager = eager
+		# profiling: name -> [calls, timed calls, seconds, max seconds,
+		# marshalling seconds] and wrappers of functions, keyed as
+		# compiled functions (attribute name and 'fun:proto')
+		self.__stats = {}
+		self.__wrappers = {}
+		self.__adhoc_wrappers = {}
+		self.__profiling = False
+		self.__period = 1
+		if profile:
+			self.profile( True, sample )
 
 		if verbose:
 			self.__call_without_prototype = self.__verbose_call_without_prototype
 		else:
 			self.__call_without_prototype = self.__quiet_call_without_prototype
 
+		if eager:
+			self.bind()
+
+	def bind( self ):
+		"""Compile all functions of proto_table and set them as instance
+		attributes, so obj.fun is usual attribute lookup and __getattr__()
+		is not called. Functions which are absent in DLL are skipped
+		(error will be raised on their using only)"""
+		for attr in self.proto_table:
+			try:
+				f = self.__resolve( attr )
+			except AttributeError:
+				continue
+			setattr( self, attr, f )
+
 	def ctype( self, type_name ):
 		"""Return ctype constructor for type_name. type_name
 		is string, any of 'char', 'byte', etc. and Prolog internal
@@ -62,52 +111,67 @@ class Caller:
 		type constructor"""
 		return ctypes.POINTER( ctype )
 
+	def __compile( self, funname, proto ):
+		"""Create ctypes function object for funname with fixed
+		signature. proto is string like:
+		'int,float->int' (return int, expect int and float) OR
+		'->int' (return int) OR
+		'int,float' (expect int,float) OR
+		'void->int' (return int, expect nothing) OR
+		'' (no prototype, ctypes defaults).
+
+		SPACES NOT ALLOWED!
+		"""
+		if not proto:
+			return getattr( self.dll, funname )
+		# own function object (not shared dll attribute), so different
+		# prototypes of the same function does not conflict
+		fun = self.dll[funname]
+		synt = proto.split('->')
+		restype = synt[1] if len(synt)==2 else None
+		argtypes = synt[0]
+		# set restype if it was specified
+		if restype == 'void':
+			fun.restype = None
+		elif restype:
+			restype = self.types_table.get( restype, None )
+			# unknown type name: leave ctypes default
+			if restype:
+				fun.restype = restype
+		# set argtypes if it was specified
+		if argtypes == 'void':
+			fun.argtypes = []
+		elif argtypes:
+			argtypes = argtypes.split( ',' )
+			argtypes = [self.types_table.get(t,None) for t in argtypes]
+			# if there are invalid types names, argtypes are not
+			# specified. It make possible to igore unknown data types
+			if None not in argtypes:
+				fun.argtypes = argtypes
+		return fun
+
 	def __get_fun( self, fun ):
-		"""Will call function of dynamic load library.
+		"""Return function of dynamic load library.
 		fun is string like:
 		'something_fun:int,int->float' OR
 		'something_fun->int' OR
 		'something_fun:int,int' OR
 		'something_fun'.
+		Prototype is compiled once, next calls are only
+		dictionary lookup.
 
 		SPACES NOT ALLOWED!
 		"""
-		fun = fun.split( ':' )
-		funname = fun[0]
-		#funname = 'PL_%s'%fun[0]
-		proto = fun[1] if len(fun)>1 else ''
-		def wrap( *a ):
-			"""proto is string like:
-			'int,float->int' (return int, expect int and float) OR
-			'->int' (return int) OR
-			'int,float' (expect int,float).
-
-			SPACES NOT ALLOWED!
-			"""
-			fun = getattr( self.dll, funname ) # function from library
-			if proto:
-				# if proto is used, prepare result type and arguments
-				synt = proto.split('->')
-				restype = synt[1] if len(synt)==2 else None
-				argtypes = synt[0]
-				# set restype if it was specified
-				if restype: restype = self.types_table.get( restype, None )
-				# set argtypes if it was specified
-				if argtypes:
-					argtypes = argtypes.split( ',' )
-					argtypes = [self.types_table.get(t,None) for t in argtypes]
-					# filtering all None/unknown types!
-					if None in argtypes:
-						argtypes = None
-				# if restype and argtypes True (there aren't invalid types names) -
-				# specified to function prototype. It make possible to
-				# igore unknown data types
-				if restype:
-					fun.restype = restype
-				if argtypes:
-					fun.argtypes = argtypes
-			return fun( *a )
-		return wrap
+		try:
+			f = self.__adhoc_funs[fun]
+		except KeyError:
+			funname, _, proto = fun.partition( ':' )
+			f = self.__adhoc_funs[fun] = self.__compile( funname, proto )
+		if self.__profiling:
+			# 'fun' call is not the same function as attribute fun
+			name = fun if ':' in fun else fun + ':'
+			return self.__profiled( self.__adhoc_wrappers, fun, name, f )
+		return f
 
 	def __call__( self, fun ):
 		"""More usuable interfase. Calling like this:
@@ -123,19 +187,128 @@ class Caller:
 		return getattr( self.dll, attr )
 
 	def __verbose_call_without_prototype( self, attr ):
-		"""Call with warning message"""
+		"""Call with warning message (once for each function)"""
 		warn( 'Call of \'%s\' without prototype'%attr )
 		return getattr( self.dll, attr )
 
+	def __resolve( self, attr ):
+		"""Return (cached) function attr with prototype from
+		proto_table if it exists"""
+		try:
+			f = self.__funs[attr]
+		except KeyError:
+			if attr in self.proto_table:
+				f = self.__compile( attr, self.proto_table[attr] )
+			else:
+				f = self.__call_without_prototype( attr )
+			self.__funs[attr] = f
+		if self.__profiling:
+			return self.__profiled( self.__wrappers, attr, attr, f )
+		return f
+
+	def profile( self, enabled=True, sample=1.0 ):
+		"""Enable (or disable) profiling of calls. All calls are
+		counted, sample (0..1] of them are timed: wall time of the call
+		and time of arguments marshalling (conversion by argtypes), so
+		sample < 1 keeps overhead small. Functions which are taken before
+		(and kept in variables) are not profiled"""
+		if not 0 < sample <= 1:
+			raise ValueError( 'sample must be in (0, 1]' )
+		self.__period = int( round( 1.0/sample ) )
+		self.__profiling = enabled
+		self.__wrappers.clear()
+		self.__adhoc_wrappers.clear()
+		# drop functions bound as attributes: they are bound again
+		for attr in self.__funs:
+			self.__dict__.pop( attr, None )
+		if self.__eager:
+			self.bind()
+
+	def stats( self ):
+		"""Return dictionary of profiling data: name -> dictionary with
+		calls, timed (number of timed calls), seconds, max, marshal
+		(seconds of timed calls) and total (estimation of seconds of all
+		calls). name is attribute name or 'fun:proto' of ad-hoc call
+		(proto may be empty: 'fun:')"""
+		res = {}
+		for name, (calls, timed, seconds, longest, marshal) in self.__stats.items():
+			if calls:
+				res[name] = dict( calls=calls, timed=timed, seconds=seconds,
+					max=longest, marshal=marshal,
+					total=seconds*calls/timed if timed else 0.0 )
+		return res
+
+	def reset_stats( self ):
+		"""Zero profiling data"""
+		for stat in self.__stats.values():
+			stat[:] = [0, 0, 0.0, 0.0, 0.0]
+
+	def __profiled( self, wrappers, key, name, f ):
+		"""Return wrapper of function f (cached in wrappers by key) which
+		counts and times its calls as name"""
+		try:
+			return wrappers[key]
+		except KeyError:
+			pass
+		stat = self.__stats.setdefault( name, [0, 0, 0.0, 0.0, 0.0] )
+		period = self.__period
+		argtypes = getattr( f, 'argtypes', None ) or ()
+		def call( *args ):
+			stat[0] += 1
+			if stat[0] % period:
+				return f( *args )
+			t0 = _clock()
+			for tp, arg in zip( argtypes, args ):
+				tp.from_param( arg )
+			t1 = _clock()
+			res = f( *args )
+			t2 = _clock()
+			stat[1] += 1
+			stat[2] += t2 - t1
+			stat[4] += t1 - t0
+			if t2 - t1 > stat[3]:
+				stat[3] = t2 - t1
+			return res
+		wrappers[key] = call
+		return call
+
 	def __getattr__( self, attr ):
 		"""Get implicit attribute which can be function with
 		known prototype (see __init__()"""
-		if self.proto_table.has_key( attr ):
-			proto = self.proto_table[attr]
-			if proto:
-				fun = '%s:%s'%(attr,self.proto_table[attr])
-			else:
-				fun = attr
-			return self.__get_fun( fun )
-		else:
-			return self.__call_without_prototype( attr )
+		if attr.startswith( '_' ):
+			# not initialised yet (or special name), not a DLL function
+			raise AttributeError( attr )
+		f = self.__resolve( attr )
+		# bound on first use: next lookups do not call __getattr__()
+		setattr( self, attr, f )
+		return f
+
+def _test():
+	"""Test (C library functions, SWI-Prolog is not needed) -------------
+	>>> import sys
+	>>> libc = ctypes.CDLL( None if sys.platform != 'win32' else 'msvcrt' )
+	>>> c = Caller( libc, proto_table={'strlen':'char_p->int'}, profile=True )
+	>>> c.strlen( b'abc' )
+	3
+	>>> c( 'strlen:char_p->long' )( b'abcd' )
+	4
+	>>> c( 'strlen' )( b'ab' )
+	2
+	>>> c.strlen( b'' )
+	0
+	>>> sorted( (k, v['calls']) for k, v in c.stats().items() )
+	[('strlen', 2), ('strlen:', 1), ('strlen:char_p->long', 1)]
+	>>> c.reset_stats()
+	>>> c.stats()
+	{}
+	>>> c.profile( False )
+	>>> c.strlen( b'abc' )
+	3
+	>>> c.stats()
+	{}
+	"""
+	import doctest
+	doctest.testmod()
+
+if __name__ == "__main__":
+	_test()
@@ -29,10 +29,37 @@ Object manipulations:
 # )
 
 from ctypes import *
+import array
+import os
 import types
 import sys
+import threading
+import time
+import marshal
+import mmap
+from itertools import islice, count
+from contextlib import contextmanager
 from plutils import Caller as DLLCaller
 
+try:
+	unicode
+except NameError:
+	# Python 3
+	unicode = str
+	long = int
+	buffer = memoryview
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+try:
+	from itertools import izip
+except ImportError:
+	# Python 3
+	izip = zip
+
 # configuration section
 
 # DLL-name depends on OS.
@@ -52,6 +79,25 @@ PL_Q_NODEBUG = 0x04				# use this one
 PL_Q_CATCH_EXCEPTION = 0x08		# handle exceptions in C
 PL_Q_PASS_EXCEPTION = 0x10      # pass to parent environment
 
+# PL_set_engine() RESULTS
+PL_ENGINE_SET = 0
+PL_ENGINE_INVAL = 2
+PL_ENGINE_INUSE = 3
+
+# PL_query() KEYS
+PL_QUERY_VERSION = 10			# version as 10000*major+100*minor+patch
+
+# PL_register_foreign() FLAGS
+PL_FA_NOTRACE = 0x01			# foreign cannot be traced
+PL_FA_TRANSPARENT = 0x02		# foreign is module transparent
+PL_FA_NONDETERMINISTIC = 0x04	# foreign is non-deterministic
+PL_FA_VARARGS = 0x08			# call using t0, ac, ctx
+
+# PL_foreign_control() RESULTS
+PL_FIRST_CALL = 0
+PL_PRUNED = 1
+PL_REDO = 2
+
 # TERM TYPE CONSTANTS
 PL_VARIABLE = 1
 PL_ATOM = 2
@@ -90,6 +136,26 @@ PL_MBCODES = 35
 PL_MBSTRING = 36
 PL_INTPTR = 37
 
+# TEXT CONVERSION FLAGS (PL_get_chars() family)
+CVT_ATOM = 0x0001
+CVT_STRING = 0x0002
+CVT_LIST = 0x0004
+CVT_INTEGER = 0x0008
+CVT_FLOAT = 0x0010
+CVT_VARIABLE = 0x0020
+CVT_NUMBER = CVT_INTEGER|CVT_FLOAT
+CVT_ATOMIC = CVT_NUMBER|CVT_ATOM|CVT_STRING
+CVT_WRITE = 0x0040
+CVT_ALL = CVT_ATOMIC|CVT_LIST
+
+BUF_DISCARDABLE = 0x0000
+BUF_RING = 0x0100
+BUF_MALLOC = 0x0200
+
+REP_ISO_LATIN_1 = 0x0000
+REP_UTF8 = 0x1000
+REP_MB = 0x2000
+
 
 def term_t_to_integer( pl_term ):
 	pass
@@ -105,12 +171,182 @@ def safer( f, defval=None ):
 			return defval
 	return w
 
+try:
+	# address of read-only buffer (Python 2 only)
+	_as_read_buffer = pythonapi.PyObject_AsReadBuffer
+	_as_read_buffer.argtypes = [py_object, POINTER(c_void_p), POINTER(c_ssize_t)]
+except AttributeError:
+	_as_read_buffer = None
+
+def buffer_data( obj ):
+	"""Return (data, length) of bytes or buffer-protocol object obj
+	(bytearray, memoryview, mmap, array, ...) for void_p argument of
+	SWI-Prolog function. Data are not copied: data is obj itself (bytes)
+	or address of its memory, so obj must be alive (and not resized) while
+	data are used. Only read-only buffers which do not give their memory
+	are copied"""
+	if isinstance( obj, bytes ):
+		return obj, len( obj )
+	try:
+		m = memoryview( obj )
+		size = m.itemsize
+		for dim in m.shape or ():
+			size *= dim
+	except TypeError:
+		m = None
+		size = len( buffer(obj) ) # old-style buffer (Python 2)
+	try:
+		return addressof( (c_char*size).from_buffer( obj ) ), size
+	except TypeError:
+		pass # read-only
+	if _as_read_buffer is not None:
+		ptr = c_void_p()
+		length = c_ssize_t()
+		try:
+			_as_read_buffer( obj, byref(ptr), byref(length) )
+			return ptr.value, length.value
+		except TypeError:
+			pass
+	data = m.tobytes() if m is not None else bytes( obj )
+	return data, len( data )
+
+def numeric_array( seq, kind=None ):
+	"""Return array.array of typecode kind for seq: array.array,
+	buffer-protocol object (numpy array, for example) or any sequence
+	of numbers. kind None is typecode (format) of seq or 'd'. Arrays
+	of the same typecode are returned as is, buffers are copied once"""
+	if isinstance( seq, array.array ):
+		if kind is None or kind == seq.typecode:
+			return seq
+		return array.array( kind, seq )
+	try:
+		m = memoryview( seq )
+	except TypeError:
+		return array.array( kind or 'd', seq )
+	fmt = m.format.lstrip( '@=<>!' )
+	a = array.array( fmt )
+	if hasattr( a, 'frombytes' ):
+		a.frombytes( m.tobytes() )
+	else:
+		a.fromstring( m.tobytes() ) # Python 2
+	if kind is None or kind == fmt:
+		return a
+	return array.array( kind, a )
+
+def _float_text( text ):
+	"""Return float of text written by Prolog: 1.5, 1.0e10, inf or
+	1.0Inf, -1.0Inf, 1.5NaN (SWI-Prolog 8+)"""
+	try:
+		return float( text )
+	except ValueError:
+		return float( text.replace( '1.0Inf', 'inf' ).replace( '1.5NaN', 'nan' ) )
+
+def size_option( size ):
+	"""Return size (bytes, int) as SWI-Prolog option value ('1024k').
+	Strings like '512m', '2g' are returned as is"""
+	if isinstance( size, (int, long) ) and not isinstance( size, bool ):
+		if size <= 0:
+			raise ValueError( 'size must be positive' )
+		return '%dk'%((size + 1023)//1024)
+	if isinstance( size, str ) and (size.isdigit() or
+			size[:-1].isdigit() and size[-1] in 'kmgKMG'):
+		return size
+	raise ValueError( 'bad size %r'%(size,) )
+
+def _evict_lru( entries, n ):
+	"""Remove n least recently used entries of dictionary entries
+	(key -> [value, tick of last use, ...]) and return list of removed
+	(key, entry)"""
+	old = sorted( entries.items(), key=lambda kv: kv[1][1] )[:n]
+	for key, entry in old:
+		del entries[key]
+	return old
+
+def _new_atom( pl, chars ):
+	"""Create atom (with reference) from str or unicode chars. Unicode
+	text goes as UTF-8"""
+	if type( chars ) == unicode:
+		chars = chars.encode( 'utf-8' )
+		return pl.PL_new_atom_mbchars( REP_UTF8, len(chars), chars )
+	return pl.PL_new_atom_nchars( len(chars), chars )
+
 #--------------------------------- Base error ------------------------------
 class PlError( Exception ): pass
 
+class PlException( PlError ):
+	"""Exception thrown by Prolog goal. term is decoded exception term
+	(see PlDecoder). For ISO error terms error(Formal, Context) formal
+	and context are decoded Formal and Context, else they are None"""
+	def __init__( self, term ):
+		PlError.__init__( self, term )
+		self.term = term
+		if type( term ) == tuple and len( term ) == 3 and term[0] == 'error':
+			self.formal, self.context = term[1], term[2]
+		else:
+			self.formal = self.context = None
+
+class PlInstantiationError( PlException ): pass
+class PlUninstantiationError( PlException ): pass
+class PlTypeError( PlException ): pass
+class PlDomainError( PlException ): pass
+class PlExistenceError( PlException ): pass
+class PlPermissionError( PlException ): pass
+class PlRepresentationError( PlException ): pass
+class PlEvaluationError( PlException ): pass
+class PlResourceError( PlException ): pass
+class PlSyntaxError( PlException ): pass
+class PlSystemError( PlException ): pass
+
+# name of ISO error Formal -> class of exception
+ISO_ERRORS = {
+	'instantiation_error':PlInstantiationError,
+	'uninstantiation_error':PlUninstantiationError,
+	'type_error':PlTypeError,
+	'domain_error':PlDomainError,
+	'existence_error':PlExistenceError,
+	'permission_error':PlPermissionError,
+	'representation_error':PlRepresentationError,
+	'evaluation_error':PlEvaluationError,
+	'resource_error':PlResourceError,
+	'syntax_error':PlSyntaxError,
+	'system_error':PlSystemError,
+	}
+
+def exception_from_term( term ):
+	"""Return PlException (or its subclass for ISO error) for decoded
+	exception term"""
+	cls = PlException
+	if type( term ) == tuple and len( term ) == 3 and term[0] == 'error':
+		formal = term[1]
+		name = formal[0] if type( formal ) == tuple else formal
+		if type( name ) in (str, unicode):
+			cls = ISO_ERRORS.get( name, PlException )
+	return cls( term )
+
+def check_exception( pl, qid=0 ):
+	"""Raise PlException if query qid (PlUtils pl) has exception. qid
+	0 is for PL_call_predicate() with PlEngine.Q_PASS_FLAGS (with
+	PL_Q_CATCH_EXCEPTION exception is dropped when query is closed),
+	PL_call() and so on: the exception is cleared then"""
+	ex = pl.PL_exception( qid )
+	if ex:
+		exc = exception_from_term( pl.decoder().decode( ex ) )
+		if not qid:
+			pl.PL_clear_exception()
+		raise exc
+
+def stack_error( pl ):
+	"""Raise exception of failed PL_put_*() or PL_cons_*() (PlUtils
+	pl): they fail if global stack can not grow"""
+	check_exception( pl )
+	raise PlError( 'can not build term: global stack is full' )
+
 #----------------------- Base Prolog object --------------------------------
 class PlObject( object ):
-	"""SWI-Prolog object in Python representation"""
+	"""SWI-Prolog object in Python representation. Wrappers of handles
+	(terms, atoms, functors) have slots but not __dict__: there may be
+	very many of them"""
+	__slots__ = ('pl',)
 
 	def __init__( self, pl ):
 		self.pl = pl
@@ -121,20 +357,35 @@ class PlUtils( DLLCaller, PlObject ):
 	term_t, atom_t) which is accessible in Python classes as:
 	'obj.pl_SOMETHING or usual C-types'
 	"""
-	def __init__( self, pl ):
+	def __init__( self, pl, eager=False, profile=None ):
+		"""pl is loaded SWI-Prolog DLL. If eager==True all
+		functions with prototypes are bound at once (see
+		DLLCaller.bind()). If profile is not None, it is sample
+		rate of profiling (see DLLCaller.profile())"""
+		# handles are integers of pointer size (uintptr_t), so
+		# term_t vector is term_t..term_t+n-1
 		_TYPE_CONS = {
 		'module_t':c_void_p,
-		'atom_t':POINTER(c_uint),
+		'atom_t':c_size_t,
 		'predicate_t':c_void_p,
 		'record_t':c_void_p,
-		'term_t':POINTER(c_uint),
-		'qid_t':POINTER(c_uint),
+		'term_t':c_size_t,
+		'qid_t':c_size_t,
 		'control_t':c_void_p,
-		'functor_t':POINTER(c_uint),
+		'functor_t':c_size_t,
+		'fid_t':c_size_t,
+		'PL_engine_t':c_void_p,
+		'atom_t_p':POINTER(c_size_t),
+		'functor_t_p':POINTER(c_size_t),
+		'size_t_p':POINTER(c_size_t),
+		'int64_p':POINTER(c_longlong),
+		'double_p':POINTER(c_double),
+		'void_p_p':POINTER(c_void_p),
 		}
 		_PROTO = {
 		'PL_initialise':'->int',
 		'PL_halt':'int',
+		'PL_query':'c_int->c_long',
 		'PL_new_term_refs':'c_int->term_t',
 		'PL_new_term_ref':'void->term_t',
 		'PL_copy_term_ref':'term_t->term_t',
@@ -142,9 +393,10 @@ class PlUtils( DLLCaller, PlObject ):
 		'PL_new_atom':'char_p->atom_t',
 		'PL_new_atom_nchars':'c_int,char_p->atom_t',
 		'PL_new_atom_wchars':'c_int,c_wchar_p->atom_t',
+		'PL_new_atom_mbchars':'c_int,size_t,void_p->atom_t',
 		'PL_atom_chars':'atom_t->char_p',
-		'PL_atom_nchars':'atom_t,c_int_p->char_p',
-		'PL_atom_wchars':'atom_t,c_int_p->c_wchar_p',
+		'PL_atom_nchars':'atom_t,size_t_p->char_p',
+		'PL_atom_wchars':'atom_t,size_t_p->c_wchar_p',
 		'PL_new_functor':'atom_t,c_int->functor_t',
 		'PL_functor_name':'functor_t->atom_t',
 		'PL_functor_arity':'functor_t->c_int',
@@ -155,12 +407,13 @@ class PlUtils( DLLCaller, PlObject ):
 		'PL_put_list_chars':'term_t,char_p->void',
 		'PL_put_list_codes':'term_t,char_p->void',
 		'PL_put_atom_nchars':'term_t,c_int,char_p->void',
-		'PL_put_string_nchars':'term_t,c_int,char_p->void',
+		'PL_put_string_nchars':'term_t,size_t,void_p->void',
+		'PL_unify_chars':'term_t,c_int,size_t,void_p->c_int',
 		'PL_put_list_nchars':'term_t,c_int,char_p->void',
 		'PL_put_list_ncodes':'term_t,c_int,char_p->void',
-		'PL_put_integer':'term_t,c_long->void',
+		'PL_put_integer':'term_t,c_long->c_int',
 		'PL_put_pointer':'term_t,c_void_p->void',
-		'PL_put_float':'term_t,c_double->void',
+		'PL_put_float':'term_t,c_double->c_int',
 		'PL_put_functor':'term_t,functor_t->void',
 		'PL_put_list':'term_t->void',
 		'PL_put_nil':'term_t->void',
@@ -177,11 +430,72 @@ class PlUtils( DLLCaller, PlObject ):
 		'PL_is_list':'term_t->c_int',
 		'PL_is_atomic':'term_t->c_int',
 		'PL_is_number':'term_t->c_int',
+		'PL_put_term':'term_t,term_t->void',
+		'PL_predicate':'char_p,c_int,char_p->predicate_t',
+		'PL_open_query':'module_t,c_int,predicate_t,term_t->qid_t',
+		'PL_next_solution':'qid_t->c_int',
+		'PL_cut_query':'qid_t->void',
+		'PL_close_query':'qid_t->void',
+		'PL_register_atom':'atom_t->void',
+		'PL_unregister_atom':'atom_t->void',
+		'PL_put_int64':'term_t,int64->c_int',
+		'PL_cons_functor_v':'term_t,functor_t,term_t->c_int',
+		'PL_cons_list':'term_t,term_t,term_t->c_int',
+		'PL_chars_to_term':'char_p,term_t->c_int',
+		'PL_term_type':'term_t->c_int',
+		'PL_get_atom':'term_t,atom_t_p->c_int',
+		'PL_get_int64':'term_t,int64_p->c_int',
+		'PL_get_float':'term_t,double_p->c_int',
+		'PL_get_atom_nchars':'term_t,size_t_p,void_p_p->c_int',
+		'PL_get_string':'term_t,void_p_p,size_t_p->c_int',
+		'PL_get_nchars':'term_t,size_t_p,void_p_p,uint->c_int',
+		'PL_get_wchars':'term_t,size_t_p,void_p_p,uint->c_int',
+		'PL_get_functor':'term_t,functor_t_p->c_int',
+		'PL_get_arg':'c_int,term_t,term_t->c_int',
+		'PL_get_list':'term_t,term_t,term_t->c_int',
+		'PL_get_nil':'term_t->c_int',
+		'PL_get_name_arity':'term_t,atom_t_p,c_int_p->c_int',
+		'PL_skip_list':'term_t,term_t,size_t_p->c_int',
+		'PL_open_foreign_frame':'void->fid_t',
+		'PL_close_foreign_frame':'fid_t->void',
+		'PL_discard_foreign_frame':'fid_t->void',
+		'PL_rewind_foreign_frame':'fid_t->void',
+		'PL_create_engine':'void_p->PL_engine_t',
+		'PL_destroy_engine':'PL_engine_t->c_int',
+		'PL_set_engine':'PL_engine_t,void_p->c_int',
+		'PL_thread_self':'void->c_int',
+		'PL_thread_attach_engine':'void_p->c_int',
+		'PL_thread_destroy_engine':'void->c_int',
+		'PL_call_predicate':'module_t,c_int,predicate_t,term_t->c_int',
+		'PL_call':'term_t,module_t->c_int',
+		'PL_exception':'qid_t->term_t',
+		'PL_record':'term_t->record_t',
+		'PL_recorded':'record_t,term_t->c_int',
+		'PL_erase':'record_t->void',
+		'PL_duplicate_record':'record_t->record_t',
+		'PL_record_external':'term_t,size_t_p->void_p',
+		'PL_recorded_external':'void_p,term_t->c_int',
+		'PL_erase_external':'void_p->c_int',
+		'PL_raise_exception':'term_t->c_int',
+		'PL_unify':'term_t,term_t->c_int',
+		'PL_register_foreign_in_module':'char_p,char_p,c_int,void_p,c_int->c_int',
+		'PL_foreign_control':'control_t->c_int',
+		'PL_foreign_context':'control_t->size_t',
+		'PL_clear_exception':'void->void',
 
 		}
 		PlObject.__init__( self, pl )
 		verb = True if __debug__ else False
-		DLLCaller.__init__( self, pl, _TYPE_CONS, _PROTO, verbose=verb )
+		DLLCaller.__init__( self, pl, _TYPE_CONS, _PROTO, verbose=verb, eager=eager,
+			profile=profile is not None, sample=profile or 1.0 )
+		self.__decoder = None
+
+	def decoder( self ):
+		"""Return PlDecoder shared by all objects which use
+		this PlUtils"""
+		if self.__decoder is None:
+			self.__decoder = PlDecoder( self )
+		return self.__decoder
 
 	#def __call__( self, fun ):
 	#	"""More usuable interfase. Calling like this:
@@ -192,6 +506,8 @@ class PlUtils( DLLCaller, PlObject ):
 
 #-------------------------------------- Term -----------------------------------
 class PlTerm( PlObject ): # : =/__int__,__float__  ..
+	__slots__ = ('num', 'pl_term')
+
 	def __init__( self, pl, num=1 ):
 		"""num - number of terms if this is the term vector creation.
 		If num == 0 PlTerm will be uninitialised and does not
@@ -209,11 +525,11 @@ class PlTerm( PlObject ): # 
 			elif num > 1:
 				self.pl_term = self.pl.PL_new_term_refs( self.num )
 
-	def _init_from_pl( self, pl_term ):
-		"""Init from SWI-Prolog term handle.
-		Use it currefully only if PlTerm was not initialisied in
-		constructor (num==0)!"""
-		self.num = 1
+	def _init_from_pl( self, pl_term, num=1 ):
+		"""Init from SWI-Prolog term handle (or vector of num
+		handles). Use it currefully only if PlTerm was not initialisied
+		in constructor (num==0)!"""
+		self.num = num
 		self.pl_term = pl_term
 
 	def __len__( self ): return self.num
@@ -256,9 +572,45 @@ class PlTerm( PlObject ): # 
 
 	def put_string_nchars( self, len, buf ):
 		"""Put a string, represented by a length/start pointer pair
-		in the term-reference. The data will be copied. This interface
-		can deal with 0-bytes in the string"""
-		self.pl.PL_put_string_nchars( self.pl_term, len, c_char_p(buf) )
+		in the term-reference. The data will be copied (by SWI-Prolog
+		only: buf may be bytes or any buffer-protocol object, see
+		buffer_data()). This interface can deal with 0-bytes in the string"""
+		data, size = buffer_data( buf )
+		if len > size:
+			raise ValueError( 'length is bigger than buffer' )
+		self.pl.PL_put_string_nchars( self.pl_term, len, data )
+
+	def unify_chars( self, flags, buf ):
+		"""Unify the term with text from buf (bytes or buffer-protocol
+		object, it is not copied by Python, see buffer_data()). flags are
+		type of term (PL_ATOM, PL_STRING, PL_CODE_LIST, PL_CHAR_LIST) and
+		representation of text (REP_ISO_LATIN_1, REP_UTF8, REP_MB).
+		unicode buf is put as UTF-8. Return True on success"""
+		if type( buf ) == unicode:
+			buf = buf.encode( 'utf-8' )
+			flags |= REP_UTF8
+		data, size = buffer_data( buf )
+		return bool( self.pl.PL_unify_chars( self.pl_term, flags, size, data ) )
+
+	def get_nchars( self, flags=CVT_ATOM|CVT_STRING|BUF_DISCARDABLE, into=None ):
+		"""Return text of the term as bytes (encoded by REP_* of flags).
+		flags are CVT_* (which terms are converted), BUF_* and REP_*, see
+		PL_get_nchars(). If into (writable buffer: bytearray, mmap, ...)
+		is given, text is copied to it directly and its length is returned,
+		TypeError is raised if into is read-only or too small.
+		Raise PlError if the term can not be converted"""
+		size = c_size_t()
+		chars = c_void_p()
+		if not self.pl.PL_get_nchars( self.pl_term, byref(size), byref(chars), flags ):
+			raise PlError( 'can not get text of term' )
+		if into is None:
+			return string_at( chars.value, size.value )
+		try:
+			dst = (c_char*size.value).from_buffer( into )
+		except (TypeError, ValueError):
+			raise TypeError( 'arg 2 must be writable buffer of enough size' )
+		memmove( dst, chars.value, size.value )
+		return size.value
 
 	def put_list_chars( self, chars ):
 		"""Put a list of ASCII values in the term-reference"""
@@ -266,15 +618,18 @@ class PlTerm( PlObject ): # 
 
 	def put_integer( self, long_numb ):
 		"""Put a Prolog integer in the term reference"""
-		self.pl.PL_put_integer( self.pl_term, c_long(long_numb) )
+		if not self.pl.PL_put_integer( self.pl_term, c_long(long_numb) ):
+			stack_error( self.pl )
 
 	def put_int64( self, int64_numb ):
 		"""Put a Prolog integer in the term reference"""
-		self.pl.PL_put_int64( self.pl_term, c_longlong(int64_numb) )
+		if not self.pl.PL_put_int64( self.pl_term, c_longlong(int64_numb) ):
+			stack_error( self.pl )
 
 	def put_float( self, float_numb ):
 		"""Put a floating-point value in the term-reference"""
-		self.pl.PL_put_float( self.pl_term, c_double(float_numb) )
+		if not self.pl.PL_put_float( self.pl_term, c_double(float_numb) ):
+			stack_error( self.pl )
 
 	def put_functor( self, functor ):
 		"""Create a new compound term from functor and bind
@@ -290,6 +645,55 @@ class PlTerm( PlObject ): # 
 		"""Same as put_atom_chars('[]')"""
 		self.pl.PL_put_nil( self.pl_term )
 
+	def put_array( self, seq, kind=None ):
+		"""Put list of numbers from seq (array.array, numpy array or
+		other buffer, list, ...) in the term-reference. Elements are
+		floats if kind (typecode of array.array, see numeric_array()) is
+		'f' or 'd' (or None for list and tuple), else integers (64-bit).
+		The list is built from the end in one scratch term handle"""
+		if not isinstance( seq, (list, tuple) ):
+			seq = numeric_array( seq, kind )
+			kind = seq.typecode
+		pl = self.pl
+		put = pl.PL_put_float if (kind or 'd') in 'fd' else pl.PL_put_int64
+		cons_list = pl.PL_cons_list
+		t = self.pl_term
+		h = pl.PL_new_term_ref()
+		pl.PL_put_nil( t )
+		for x in reversed( seq ):
+			if not (put( h, x ) and cons_list( t, h, t )):
+				stack_error( pl )
+		pl.PL_reset_term_refs( h )
+
+	def get_array( self, kind='d' ):
+		"""Return array.array of typecode kind with numbers of the
+		Prolog list (integers are converted to floats for 'f' and 'd').
+		Use numpy.frombuffer() on result to get numpy array without copy.
+		Raise PlError if the term is not a list of numbers"""
+		pl = self.pl
+		res = array.array( kind )
+		append = res.append
+		if kind in 'fd':
+			val = c_double()
+			get = pl.PL_get_float
+		else:
+			val = c_longlong()
+			get = pl.PL_get_int64
+		ref = byref( val )
+		get_list = pl.PL_get_list
+		l = pl.PL_copy_term_ref( self.pl_term )
+		h = pl.PL_new_term_ref()
+		try:
+			while get_list( l, h, l ):
+				if not get( h, ref ):
+					raise PlError( 'list element %d is not a number'%len(res) )
+				append( val.value )
+			if not pl.PL_get_nil( l ):
+				raise PlError( 'term is not a list' )
+		finally:
+			pl.PL_reset_term_refs( l )
+		return res
+
 	def put( self, obj ):
 		"""Put obj into term. Corresponds to put_*() family methods.
 		obj is switcher to choose correct put_*() method, so:
@@ -311,8 +715,8 @@ class PlTerm( PlObject ): # 
 			self.put_atom( obj )
 		elif isinstance( obj, str ):
 			self.put_string_chars( obj )
-		elif isinstance( obj, buffer ):
-			self.put_string_nchars( len(obj), str(obj) ) # Is this safe???!!!
+		elif isinstance( obj, (buffer, bytearray, mmap.mmap) ):
+			self.put_string_nchars( len(obj), obj )
 		elif isinstance( obj, (list,tuple) ):
 			# all elements of obj-sequence str()-ed and
 			# create from they one string:
@@ -346,7 +750,10 @@ class PlTerm( PlObject ): # 
 
 		if type( f ) == str:
 			f = PlFunctor( self.pl, f, len(a) )
-		self.pl.PL_cons_functor( self.pl_term, f, *[t.pl_term for t in a] )
+		# PL_cons_functor() has variable arguments: handles are passed
+		# with explicit type (pointer size)
+		self.pl.PL_cons_functor( c_size_t(self.pl_term), c_size_t(f.pl_functor),
+			*[c_size_t(t.pl_term) for t in a] )
 
 	def cons_functor_v( self, f, a0 ):
 		"""Creates a compound term like cons_functor(), but a0 is a PlTerm,
@@ -364,24 +771,27 @@ class PlTerm( PlObject ): # 
 			raise TypeError('arg 1 must be a string or PlFunctor')
 
 		if type( f ) == str:
-			f = PlFunctor( self.pl, f, len(a) )
-		self.pl.PL_cons_functor_v( self.pl_term, f, a0.pl_term )
+			f = PlFunctor( self.pl, f, len(a0) )
+		if not self.pl.PL_cons_functor_v( self.pl_term, f.pl_functor, a0.pl_term ):
+			stack_error( self.pl )
 
 	def cons_list( self, head, tail, *other_tails ):
-		"""Create a list (cons-) cell in self from the head and tail.
-		head, tail and *other_tails must be PlTerm.
-		If other_tails specified, all will be added.
-		self must be list already (use put_nil())"""
-		ts = [tail] + other_tails # all tails
-		n = len( ts )-1
-		while n >= 0:
-			self.pl.PL_cons_list( self.pl_term, ts[n], self.pl_term )
-			n -= 1
+		"""Create a list (cons-) cell in self from the head and tail:
+		[head|tail]. head, tail and *other_tails must be PlTerm.
+		If other_tails specified, the last of them is the tail and
+		all other are elements: [head,tail,...|last]"""
+		ts = (head, tail) + other_tails
+		pl_term = self.pl_term
+		self.pl.PL_put_term( pl_term, ts[-1].pl_term )
+		for t in reversed( ts[:-1] ):
+			if not self.pl.PL_cons_list( pl_term, t.pl_term, pl_term ):
+				stack_error( self.pl )
 
 	def term_type( self ):
 		"""Obtain the type of a term. Can return any of:
 		PL_VARIABLE, PL_ATOM, PL_STRING, PL_INTEGER, PL_FLOAT,
-		PL_TERM (not yet implemented).
+		PL_TERM (not yet implemented). Codes of SWI-Prolog 7+ differ
+		(PL_NIL, PL_LIST_PAIR, PL_RATIONAL), see PlDecoder.
 		Get term data also check of term's type before to read data"""
 		return self.pl.PL_term_type( self.pl_term )
 
@@ -438,42 +848,201 @@ class PlTerm( PlObject ): # 
 		the atom should be locked using PL_register_atom()"""
 
 		atom = PlAtom( self.pl, None )
-		ut = PlUtils( self.pl )
-		atom_t = ut.ctype( 'atom_t' )() # create atom_t instance!
+		atom_t = self.pl.ctype( 'atom_t' )() # create atom_t instance!
 		self.pl.PL_get_atom( self.pl_term, byref(atom_t) )
-		atom._init_from_pl( atom_t )
+		atom._init_from_pl( atom_t.value )
 		return atom
+
+	def to_python( self ):
+		"""Return Python data for the term (see PlDecoder). If self
+		is vector, return tuple of data for all its terms"""
+		if self.is_vector():
+			return self.pl.decoder().decode_vector( self.pl_term, self.num )
+		return self.pl.decoder().decode( self.pl_term )
+
+	# Views: walk the term without decoding of all it. len() is
+	# length of vector, length() is length of list
+
+	def name_arity( self ):
+		"""Return (name, arity) of compound or atom (arity 0)"""
+		atom = self.pl.ctype( 'atom_t' )()
+		arity = c_int()
+		if not self.pl.PL_get_name_arity( self.pl_term, byref(atom), byref(arity) ):
+			raise PlError( 'term is not compound or atom' )
+		return self.pl.PL_atom_chars( atom.value ), arity.value
+
+	def arg( self, index, decode=True ):
+		"""Return argument index (1..arity) of compound: decoded data or,
+		if decode is False, new PlTerm"""
+		pl = self.pl
+		t = pl.PL_new_term_ref()
+		if not pl.PL_get_arg( index, self.pl_term, t ):
+			pl.PL_reset_term_refs( t )
+			raise IndexError( 'term has not argument %d'%index )
+		if not decode:
+			term = PlTerm( pl, 0 )
+			term._init_from_pl( t )
+			return term
+		try:
+			return pl.decoder().decode( t )
+		finally:
+			pl.PL_reset_term_refs( t )
+
+	def iter_args( self, decode=True ):
+		"""Iterate arguments of compound (see iter_list())"""
+		arity = self.name_arity()[1]
+		pl = self.pl
+		t = pl.PL_new_term_ref()
+		try:
+			view = PlTerm( pl, 0 )
+			view._init_from_pl( t )
+			decode = pl.decoder().decode if decode else None
+			for i in range( 1, arity+1 ):
+				pl.PL_get_arg( i, self.pl_term, t )
+				yield decode( t ) if decode else view
+		finally:
+			pl.PL_reset_term_refs( t )
+
+	def iter_list( self, decode=True ):
+		"""Iterate elements of list: decoded data or, if decode is
+		False, the same PlTerm for each element, it is valid until the
+		next step. Two cursor term handles are used for all list, so
+		memory does not depend on list length. They (and handles created
+		while iterating) are released when iteration is finished or
+		closed. Raise PlError if list is not proper (at its end)"""
+		pl = self.pl
+		l = pl.PL_copy_term_ref( self.pl_term )
+		try:
+			h = pl.PL_new_term_ref()
+			view = PlTerm( pl, 0 )
+			view._init_from_pl( h )
+			get_list = pl.PL_get_list
+			decode = pl.decoder().decode if decode else None
+			while get_list( l, h, l ):
+				yield decode( h ) if decode else view
+			if not pl.PL_get_nil( l ):
+				raise PlError( 'term is not a proper list' )
+		finally:
+			pl.PL_reset_term_refs( l )
+
+	def length( self ):
+		"""Return length of proper list (PL_skip_list()), raise PlError
+		if term is not proper list"""
+		pl = self.pl
+		tail = pl.PL_new_term_ref()
+		size = c_size_t()
+		try:
+			pl.PL_skip_list( self.pl_term, tail, byref(size) )
+			if not pl.PL_get_nil( tail ):
+				raise PlError( 'term is not a proper list' )
+		finally:
+			pl.PL_reset_term_refs( tail )
+		return size.value
+
+class PlTermVector( PlTerm ):
+	"""Vector of num consecutive term handles: base handle pl_term and
+	length. Index gives PlTerm, slice (with step 1) gives PlTermVector
+	view of the same handles, handle(i) gives term_t without any object.
+	put() fills handles from sequence without object per item"""
+	__slots__ = ()
+
+	def __init__( self, pl, num=1 ):
+		"""Create vector of num handles. If num == 0 vector is not
+		initialised, see PlTerm"""
+		super( PlTermVector, self ).__init__( pl, num )
+
+	def handle( self, index ):
+		"""Return term_t of item index (negative is from the end)"""
+		if index < 0:
+			index += self.num
+		if not 0 <= index < self.num:
+			raise IndexError( 'term index out of range' )
+		return self.pl_term + index
+
+	def __getitem__( self, index ):
+		if isinstance( index, slice ):
+			start, stop, step = index.indices( self.num )
+			if step != 1:
+				raise ValueError( 'slice step must be 1' )
+			vec = PlTermVector( self.pl, 0 )
+			vec._init_from_pl( self.pl_term + start, max( 0, stop - start ) )
+			return vec
+		term = PlTerm( self.pl, 0 )
+		term._init_from_pl( self.handle( index ) )
+		return term
+
+	def __iter__( self ):
+		for i in range( self.num ):
+			yield self[i]
+
+	def handles( self ):
+		"""Return range of term_t of all items"""
+		return range( self.pl_term, self.pl_term + self.num )
+
+	def put( self, seq, put_term=None ):
+		"""Put items of seq (its length must be len(self)) into handles.
+		Items are put by put_term( term_t, obj ) if it is given (see
+		PlEngine.put_term()), else by PlTerm.put() of one reused PlTerm"""
+		if len( seq ) != self.num:
+			raise ValueError( 'sequence must have %d items'%self.num )
+		base = self.pl_term
+		if put_term is None:
+			view = PlTerm( self.pl, 0 )
+			for i, obj in enumerate( seq ):
+				view._init_from_pl( base + i )
+				view.put( obj )
+		else:
+			for i, obj in enumerate( seq ):
+				put_term( base + i, obj )
+
 #------------------------------------- atom -----------------------------------
 class PlAtom( PlObject ):
+	# registered: atom is locked while self is alive
+	__slots__ = ('chars', 'pl_atom', 'registered')
 
 	def __init__( self, pl, chars ):
 		"""chars like 'xxx'. If chars is None, not created SWI-Prolog
 		object but you must call _init_from_pl()"""
 		super( PlAtom, self ).__init__( pl )
+		self.registered = False
 		if chars != None:
 			self.chars = chars
-			if type( chars ) == unicode:
-				self.pl_atom = self.pl.PL_new_atom_wchars( len( self.chars), self.chars )
-			else:
-				self.pl_atom = self.pl.PL_new_atom_nchars( len( self.chars), self.chars )
-
-	def _init_from_pl( self, pl_atom ):
-		"""Init from SWI-Prolog atom handle. Use it if not initialised only"""
-		self.pl.PL_atom_chars.restype = c_char_p
-		self.chars = self.pl.PL_atom_chars( pl_atom ) # MAY BE GARBAGE COLLECTED?!!! UNICODE???
+			self.pl_atom = _new_atom( self.pl, chars )
+			# PL_new_atom_*() returns registered atom
+			self.registered = True
+
+	def _init_from_pl( self, pl_atom, chars=None, register=False ):
+		"""Init from SWI-Prolog atom handle. Use it if not initialised only.
+		chars are known text of atom (it is not asked from SWI-Prolog then).
+		If register==True atom is locked (PL_register_atom()) while self
+		is alive"""
+		if chars is None:
+			chars = self.pl.PL_atom_chars( pl_atom ) # UNICODE???
+		self.chars = chars
 		self.pl_atom = pl_atom
+		if register:
+			self.pl.PL_register_atom( pl_atom )
+			self.registered = True
+
+	def __del__( self ):
+		if self.registered:
+			self.pl.PL_unregister_atom( self.pl_atom )
 
 	def __repr__( self ):
 		"""String representation"""
-		self.pl.PL_atom_chars.restype = c_char_p
 		return self.pl.PL_atom_chars( self.pl_atom )
 
 #----------------------------- Functor -----------------------------------------
 class PlFunctor( PlObject ):
+	__slots__ = ('name', 'arity', 'pl_functor')
+
 	def __init__( self, pl, name, arity ):
 		"""Create functor from name (PlAtom) or string (atom will be
-		created automatically) with arity"""
+		created automatically) with arity. If name is None, not
+		created SWI-Prolog object but you must call _init_from_pl()"""
 		super( PlFunctor, self ).__init__( pl )
+		if name is None:
+			return
 		if not isinstance( name, (PlAtom, str) ):
 			raise ValueError( 'arg 2 must be PlAtom or string' )
 		if type( name ) == str:
@@ -483,6 +1052,713 @@ class PlFunctor( PlObject ):
 		self.arity = arity
 		self.pl_functor = self.pl.PL_new_functor( self.name.pl_atom, arity )
 
+	def _init_from_pl( self, pl_functor, name=None, arity=None ):
+		"""Init from SWI-Prolog functor handle. Use it if not initialised
+		only. name (string) and arity are known name and arity of functor
+		(they are not asked from SWI-Prolog then)"""
+		self.name = PlAtom( self.pl, None )
+		# functor keeps its name atom, so it need not be registered
+		self.name._init_from_pl( self.pl.PL_functor_name( pl_functor ), name )
+		if arity is None:
+			arity = self.pl.PL_functor_arity( pl_functor )
+		self.arity = arity
+		self.pl_functor = pl_functor
+
+#----------------------------- Foreign frame -----------------------------------
+class PlFrame( PlObject ):
+	"""Foreign frame. All term handles (PlTerm objects too) created after
+	frame opening are released when frame is closed, so local stack does
+	not grow in long loops. Typical use is:
+	    with pleng.frame() as fr:
+	        for x in data:
+	            t = pleng.to_term( x )
+	            ...
+	            fr.rewind()
+	On normal exit of 'with' frame is closed (bindings are kept), on
+	exception it is discarded (bindings are undone). Do not use terms
+	created in frame after it is closed and close queries opened in
+	frame before. Atoms are not on local stack: PlAtom keeps its own
+	reference and interned atoms are released by atoms table"""
+
+	def __init__( self, pl ):
+		super( PlFrame, self ).__init__( pl )
+		self.pl_frame = None
+
+	def open( self ):
+		"""Open frame (PL_open_foreign_frame())"""
+		if self.pl_frame is not None:
+			raise PlError( 'frame is already opened' )
+		self.pl_frame = self.pl.PL_open_foreign_frame()
+
+	def close( self ):
+		"""Close frame: release term handles, keep bindings"""
+		self.pl.PL_close_foreign_frame( self.__opened() )
+		self.pl_frame = None
+
+	def discard( self ):
+		"""Close frame: release term handles, undo bindings"""
+		self.pl.PL_discard_foreign_frame( self.__opened() )
+		self.pl_frame = None
+
+	def rewind( self ):
+		"""Undo bindings and release term handles created after frame
+		opening, but frame is still opened"""
+		self.pl.PL_rewind_foreign_frame( self.__opened() )
+
+	def __opened( self ):
+		if self.pl_frame is None:
+			raise PlError( 'frame is not opened' )
+		return self.pl_frame
+
+	def __enter__( self ):
+		if self.pl_frame is None:
+			self.open()
+		return self
+
+	def __exit__( self, tp, value, tb ):
+		if self.pl_frame is not None:
+			if tp is None:
+				self.close()
+			else:
+				self.discard()
+		return False
+
+#----------------------------- Record ------------------------------------------
+class PlRecord( PlObject ):
+	"""Copy of term in SWI-Prolog database (PL_record()). Term is built
+	once and instantiated by term() as fresh copy (with new variables)
+	without decoding and encoding by Python. Records are shared by all
+	engines (threads) of process. Record is erased when self is deleted"""
+
+	def __init__( self, pl, pl_term ):
+		"""Record term handle pl_term. If pl_term is None, not created
+		SWI-Prolog object but you must call _init_from_pl()"""
+		super( PlRecord, self ).__init__( pl )
+		self.pl_record = None
+		if pl_term is not None:
+			self.pl_record = self.pl.PL_record( pl_term )
+
+	def _init_from_pl( self, pl_record ):
+		"""Init from SWI-Prolog record handle (self owns it then)"""
+		self.pl_record = pl_record
+
+	def __del__( self ):
+		if self.pl_record:
+			self.pl.PL_erase( self.pl_record )
+
+	def put( self, pl_term ):
+		"""Put copy of recorded term in term handle pl_term"""
+		if not self.pl.PL_recorded( self.pl_record, pl_term ):
+			raise PlError( 'can not instantiate record' )
+
+	def term( self ):
+		"""Return new PlTerm with copy of recorded term"""
+		t = PlTerm( self.pl )
+		self.put( t.pl_term )
+		return t
+
+	def copy( self ):
+		"""Return new PlRecord of the same term (PL_duplicate_record())"""
+		r = PlRecord( self.pl, None )
+		r._init_from_pl( self.pl.PL_duplicate_record( self.pl_record ) )
+		return r
+
+#----------------------------- Intern tables -----------------------------------
+class PlInternTable( PlObject ):
+	"""Table of SWI-Prolog handles with LRU eviction: key -> handle.
+	Handle is created by _new(key) on miss and released by _free(handle)
+	on eviction. If maxsize is not None, table keeps at most maxsize
+	handles: when it is full, the least recently used quarter is evicted
+	at once. Handle taken from table is valid while it is in table, so
+	do not keep it in Python (terms keep their atoms themselves)"""
+
+	def __init__( self, pl, maxsize=None ):
+		super( PlInternTable, self ).__init__( pl )
+		if maxsize is not None and maxsize <= 0:
+			raise ValueError( 'maxsize must be positive or None' )
+		self.maxsize = maxsize
+		self.hits = self.misses = self.evictions = 0
+		self.__entries = {} # key -> [handle, tick of last use]
+		self.__tick = 0
+
+	def _new( self, key ):
+		raise NotImplementedError
+
+	def _free( self, handle ):
+		pass
+
+	def __getitem__( self, key ):
+		self.__tick += 1
+		try:
+			entry = self.__entries[key]
+			self.hits += 1
+		except KeyError:
+			self.misses += 1
+			if self.maxsize is not None and len( self.__entries ) >= self.maxsize:
+				self.__evict( max( 1, self.maxsize//4 ) )
+			entry = self.__entries[key] = [self._new( key ), 0]
+		entry[1] = self.__tick
+		return entry[0]
+
+	def __len__( self ):
+		return len( self.__entries )
+
+	def __contains__( self, key ):
+		return key in self.__entries
+
+	def __evict( self, n ):
+		"""Evict n least recently used handles"""
+		old = _evict_lru( self.__entries, n )
+		for key, entry in old:
+			self._free( entry[0] )
+		self.evictions += len( old )
+
+	def clear( self ):
+		"""Release all handles"""
+		self.__evict( len(self.__entries) )
+
+	def stats( self ):
+		"""Return dictionary with size and hit/miss/eviction counters"""
+		return dict( size=len(self), maxsize=self.maxsize, hits=self.hits,
+			misses=self.misses, evictions=self.evictions )
+
+	def reset_stats( self ):
+		"""Zero hit/miss/eviction counters"""
+		self.hits = self.misses = self.evictions = 0
+
+class PlAtomTable( PlInternTable ):
+	"""Interned atoms: str/unicode -> atom_t. Table holds one reference
+	(PL_register_atom()) of each atom, it is released on eviction"""
+
+	def _new( self, chars ):
+		return _new_atom( self.pl, chars )
+
+	def _free( self, pl_atom ):
+		self.pl.PL_unregister_atom( pl_atom )
+
+class PlFunctorTable( PlInternTable ):
+	"""Interned functors: (name, arity) -> functor_t. Names are taken
+	from atoms table"""
+
+	def __init__( self, pl, atoms, maxsize=None ):
+		super( PlFunctorTable, self ).__init__( pl, maxsize )
+		self.atoms = atoms
+
+	def _new( self, key ):
+		name, arity = key
+		# functor keeps its name atom: eviction of atom is safe
+		return self.pl.PL_new_functor( self.atoms[name], arity )
+
+#----------------------------- Answer cache ------------------------------------
+def answer_key( obj ):
+	"""Return canonical hashable key of Python data obj (goal arguments,
+	see PlEngine.put_term()): equal keys are put as equal terms. Raise
+	TypeError if obj can not be keyed (PlTerm and other objects)"""
+	tp = type( obj )
+	if tp in (int, long, str, unicode) or obj is None:
+		return obj
+	if tp in (bool, float): # True == 1 == 1.0, but terms differ
+		return (tp, obj)
+	if tp in (tuple, list):
+		return (tp, tuple( [answer_key( x ) for x in obj] ))
+	if tp == dict:
+		return answer_key( [('-', k, v) for k, v in obj.items()] )
+	raise TypeError( 'can not make key of %s'%tp.__name__ )
+
+class PlAnswerCache( object ):
+	"""Memo of decoded answers of pure goals: (predicate, key of
+	arguments) -> list of solutions (tuples of decoded arguments, as
+	PlEngine.query( ..., decode=True ) yields). predicate is tuple
+	(module, name, arity), only predicates registered by add() are
+	cached. LRU eviction as in PlInternTable; if ttl is not None,
+	entries older than ttl seconds are misses. invalidate() drops
+	answers of predicate and of predicates which depend on it.
+	Memo is shared by all engines (threads) of process, so methods are
+	locked; get() returns copy of answers list:
+	    >>> memo = PlAnswerCache( 2 )
+	    >>> memo.add( ('user', 'path', 2), [('user', 'edge', 2)] )
+	    >>> memo.put( ('user', 'path', 2), (1, None), [(1, 2), (1, 3)] )
+	    >>> memo.get( ('user', 'path', 2), (1, None) )
+	    [(1, 2), (1, 3)]
+	    >>> memo.get( ('user', 'path', 2), (1, None) ).append( (1, 4) )
+	    >>> memo.get( ('user', 'path', 2), (1, None) )
+	    [(1, 2), (1, 3)]
+	    >>> memo.invalidate( ('user', 'edge', 2) )
+	    >>> memo.get( ('user', 'path', 2), (1, None) ) is None
+	    True
+	    >>> sorted( memo.stats().items() )[:3]
+	    [('evictions', 0), ('hits', 3), ('invalidations', 1)]
+	"""
+
+	def __init__( self, maxsize=1024, ttl=None ):
+		if maxsize is not None and maxsize <= 0:
+			raise ValueError( 'maxsize must be positive or None' )
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = self.misses = self.evictions = self.invalidations = 0
+		self.__entries = {} # (pred, key) -> [answers, tick, time of put]
+		self.__users = {} # pred -> set of cached preds which use it
+		self.__tick = 0
+		self.__lock = threading.Lock()
+
+	def add( self, pred, depends=() ):
+		"""Register cached predicate pred which answers depend on
+		clauses of predicates depends (and of pred itself)"""
+		with self.__lock:
+			for p in (pred,) + tuple( depends ):
+				self.__users.setdefault( p, set() ).add( pred )
+
+	def __contains__( self, pred ):
+		return pred in self.__users.get( pred, () )
+
+	def __len__( self ):
+		return len( self.__entries )
+
+	def get( self, pred, key ):
+		"""Return copy of list of answers or None on miss"""
+		with self.__lock:
+			self.__tick += 1
+			entry = self.__entries.get( (pred, key) )
+			if entry is not None and self.ttl is not None \
+					and time.time() - entry[2] > self.ttl:
+				del self.__entries[(pred, key)]
+				self.evictions += 1
+				entry = None
+			if entry is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			entry[1] = self.__tick
+			return list( entry[0] )
+
+	def put( self, pred, key, answers ):
+		"""Memoize copy of list of answers"""
+		with self.__lock:
+			entries = self.__entries
+			if self.maxsize is not None and len( entries ) >= self.maxsize \
+					and (pred, key) not in entries:
+				old = _evict_lru( entries, max( 1, self.maxsize//4 ) )
+				self.evictions += len( old )
+			entries[(pred, key)] = [list( answers ), self.__tick, time.time()]
+
+	def invalidate( self, pred=None ):
+		"""Drop answers which depend on predicate pred (all if None)"""
+		with self.__lock:
+			entries = self.__entries
+			if pred is None:
+				stale = list( entries )
+			else:
+				users = self.__users.get( pred )
+				if not users:
+					return
+				stale = [k for k in entries if k[0] in users]
+			for k in stale:
+				del entries[k]
+			self.invalidations += len( stale )
+
+	def clear( self ):
+		"""Drop all answers (registrations are kept)"""
+		with self.__lock:
+			self.__entries.clear()
+
+	def stats( self ):
+		"""Return dictionary with size and hit/miss/eviction/invalidation
+		counters"""
+		with self.__lock:
+			return dict( size=len(self), maxsize=self.maxsize, ttl=self.ttl,
+				hits=self.hits, misses=self.misses, evictions=self.evictions,
+				invalidations=self.invalidations )
+
+	def reset_stats( self ):
+		"""Zero counters"""
+		with self.__lock:
+			self.hits = self.misses = self.evictions = self.invalidations = 0
+
+#----------------------------- Decoder -----------------------------------------
+class PlDecoder( PlObject ):
+	"""Converter of terms to Python data (reverse of PlEngine.put_term()):
+	    variable    None
+	    atom        str (unicode if it is not Latin-1), [] is []
+	    integer     int, long
+	    float       float
+	    string      str (unicode if it is not Latin-1)
+	    list        [...] (tail of partial list is dropped)
+	    compound    ('f',a1,...,aN)
+	    other       str, text of written term (blob, rational, dict)
+	Decoder is reusable: ctypes out-parameters are allocated once"""
+
+	def __init__( self, pl ):
+		super( PlDecoder, self ).__init__( pl )
+		self.__int64 = c_longlong()
+		self.__double = c_double()
+		self.__size = c_size_t()
+		self.__chars = c_void_p()
+		self.__functor = c_size_t()
+		self.__functors = {} # functor_t -> (name, arity); functors are never freed
+		# functor of list cell: './2' or '[|]/2' depends on SWI-Prolog version
+		t = self.pl.PL_new_term_ref()
+		self.pl.PL_put_list( t )
+		self.pl.PL_get_functor( t, byref(self.__functor) )
+		self.__list_functor = self.__functor.value
+		# PL_term_type() codes depend on SWI-Prolog version: 7+ has
+		# PL_NIL, PL_BLOB and PL_LIST_PAIR, PL_RATIONAL of 9 shifts
+		# codes of floats, strings and compounds. So they are taken from
+		# sample terms: code -> function for atomic terms, and set of
+		# codes of compounds (PL_TERM, PL_LIST_PAIR)
+		pl = self.pl
+		self.__scalars = {}
+		self.__compounds = set()
+		f = pl.PL_new_functor( pl.PL_new_atom( b'f' ), 1 )
+		# [] before atom: they have the same code in old versions
+		for put, arg, decode in (
+				(pl.PL_put_variable, None, PlDecoder.__variable),
+				(pl.PL_put_nil, None, PlDecoder.__nil),
+				(pl.PL_put_atom_chars, b'a', PlDecoder.__atom),
+				(pl.PL_put_integer, 1, PlDecoder.__integer),
+				(pl.PL_put_float, 0.5, PlDecoder.__float),
+				(pl.PL_put_string_chars, b's', PlDecoder.__string),
+				(pl.PL_put_list, None, None),
+				(pl.PL_put_functor, f, None)):
+			if arg is None:
+				put( t )
+			else:
+				put( t, arg )
+			tp = pl.PL_term_type( t )
+			if decode is None:
+				self.__compounds.add( tp )
+			else:
+				self.__scalars[tp] = decode
+		pl.PL_reset_term_refs( t )
+
+	def decode( self, pl_term ):
+		"""Return Python data for the term handle pl_term"""
+		return self.decode_vector( pl_term, 1 )[0]
+
+	def decode_vector( self, pl_term, num ):
+		"""Return tuple of Python data for num terms of the vector
+		pl_term..pl_term+num-1. Lists and compounds are walked iteratively,
+		not recursively, with one cursor handle; only nested terms take
+		own handles, which are reset at the end"""
+		pl = self.pl
+		scalars = self.__scalars
+		compounds = self.__compounds
+		other = PlDecoder.__other
+		term_type = pl.PL_term_type
+		get_arg = pl.PL_get_arg
+		get_list = pl.PL_get_list
+		copy_term_ref = pl.PL_copy_term_ref
+		result = [None]*num
+		# (handle, container, index): put decoded handle to container[index];
+		# handle None means that container[index] is ready compound
+		stack = [(pl_term+i, result, i) for i in range( num )]
+		cursor = pl.PL_new_term_ref() # all handles from it are scratch
+		try:
+			while stack:
+				t, container, idx = stack.pop()
+				if t is None:
+					container[idx] = tuple( container[idx] )
+					continue
+				tp = term_type( t )
+				if tp not in compounds:
+					container[idx] = scalars.get( tp, other )( self, t )
+					continue
+				f = self.__get_functor( t )
+				if f == self.__list_functor:
+					items = container[idx] = []
+					tail = copy_term_ref( t )
+					while get_list( tail, cursor, tail ):
+						tp = term_type( cursor )
+						if tp in compounds:
+							stack.append( (copy_term_ref(cursor), items, len(items)) )
+							items.append( None )
+						else:
+							items.append( scalars.get( tp, other )( self, cursor ) )
+				else:
+					name, arity = self.__name_arity( f )
+					args = container[idx] = [name] + [None]*arity
+					stack.append( (None, container, idx) )
+					for i in range( 1, arity+1 ):
+						get_arg( i, t, cursor )
+						tp = term_type( cursor )
+						if tp in compounds:
+							stack.append( (copy_term_ref(cursor), args, i) )
+						else:
+							args[i] = scalars.get( tp, other )( self, cursor )
+		finally:
+			pl.PL_reset_term_refs( cursor )
+		return tuple( result )
+
+	def __get_functor( self, pl_term ):
+		self.pl.PL_get_functor( pl_term, byref(self.__functor) )
+		return self.__functor.value
+
+	def __name_arity( self, functor ):
+		"""Return (name, arity) of functor_t (cached)"""
+		try:
+			return self.__functors[functor]
+		except KeyError:
+			pl = self.pl
+			atom = pl.PL_functor_name( functor )
+			name = pl.PL_atom_nchars( atom, byref(self.__size) )
+			if name is None:
+				name = pl.PL_atom_wchars( atom, byref(self.__size) )
+			na = self.__functors[functor] = (name, pl.PL_functor_arity( functor ))
+			return na
+
+	def __wchars( self, pl_term, flags ):
+		"""Wide text of atom or string"""
+		if not self.pl.PL_get_wchars( pl_term, byref(self.__size), byref(self.__chars), flags ):
+			raise PlError( 'can not get text of term' )
+		return wstring_at( self.__chars.value, self.__size.value )
+
+	def __variable( self, pl_term ):
+		return None
+
+	def __nil( self, pl_term ):
+		return []
+
+	def __atom( self, pl_term ):
+		if self.pl.PL_get_atom_nchars( pl_term, byref(self.__size), byref(self.__chars) ):
+			s = string_at( self.__chars.value, self.__size.value )
+		else:
+			s = self.__wchars( pl_term, CVT_ATOM )
+		return [] if s == '[]' else s
+
+	def __integer( self, pl_term ):
+		if self.pl.PL_get_int64( pl_term, byref(self.__int64) ):
+			return self.__int64.value
+		# big integer
+		self.pl.PL_get_nchars( pl_term, byref(self.__size), byref(self.__chars), CVT_INTEGER )
+		return long( string_at( self.__chars.value, self.__size.value ) )
+
+	def __float( self, pl_term ):
+		self.pl.PL_get_float( pl_term, byref(self.__double) )
+		return self.__double.value
+
+	def __string( self, pl_term ):
+		if self.pl.PL_get_string( pl_term, byref(self.__chars), byref(self.__size) ):
+			return string_at( self.__chars.value, self.__size.value )
+		return self.__wchars( pl_term, CVT_STRING )
+
+	def __other( self, pl_term ):
+		"""Unknown type: text of written term"""
+		self.pl.PL_get_nchars( pl_term, byref(self.__size), byref(self.__chars), CVT_WRITE )
+		return string_at( self.__chars.value, self.__size.value )
+
+#----------------------------- Prepared goal -----------------------------------
+class PlGoal( PlObject ):
+	"""Goal template prepared once by PlEngine.prepare(): predicate
+	handle and vector of argument term handles are created once, fixed
+	arguments are put once. Call of PlGoal puts arguments for
+	placeholders only and opens query, so it is generator of solutions
+	as PlEngine.query(). Bindings made by the query are undone
+	(PL_close_query()) when generator is finished, so yielded terms are
+	valid until the next solution only. Only one call of PlGoal may be
+	active at any time. Counters of calls, solutions and seconds spent in
+	SWI-Prolog are available by stats()"""
+	# placeholder arguments of these types (and small integers) are not
+	# put again if the same object is passed in the next call: they are
+	# stored in term handle itself. Variables, floats, big integers and
+	# compounds are on global stack which is rewound by PL_close_query()
+	SAME_TYPES = frozenset( (bool, str, unicode) )
+	SMALL_INT = 1 << 24 # abs() below it is tagged integer on any platform
+
+	def __init__( self, engine, pred, a0, arity, holes, text ):
+		"""pred is predicate_t, a0 is vector of arity term handles with
+		fixed arguments, holes is list of indexes of placeholders in it"""
+		super( PlGoal, self ).__init__( engine.pl )
+		self.engine = engine
+		self.pred = pred
+		self.a0 = a0
+		self.arity = arity
+		self.holes = holes
+		self.text = text
+		self.terms = PlTermVector( self.pl, 0 )
+		self.terms._init_from_pl( a0, arity )
+		self.__last = [self] * len( holes ) # self is never equal argument
+		self.__active = False
+		self.reset_stats()
+
+	def __repr__( self ):
+		return 'PlGoal(%r)'%self.text
+
+	def __call__( self, *args, **kw ):
+		"""Generator of solutions for args (values of placeholders, see
+		PlEngine.put_term()). If keyword decode=True, yields tuple of
+		decoded arguments instead of PlTerm vector"""
+		decode = kw.pop( 'decode', False )
+		if kw:
+			raise TypeError( 'unexpected keyword argument \'%s\''%kw.popitem()[0] )
+		if len( args ) != len( self.holes ):
+			raise TypeError( '%r takes %d arguments (%d given)'%(self,
+				len( self.holes ), len( args )) )
+		return self.__run( args, decode )
+
+	def __run( self, args, decode ):
+		if self.__active:
+			raise PlError( '%r is active already'%self )
+		pl = self.pl
+		a0 = self.a0
+		last = self.__last
+		put_term = self.engine.put_term
+		same_types = self.SAME_TYPES
+		small = self.SMALL_INT
+		for n, i in enumerate( self.holes ):
+			arg = args[n]
+			if arg is last[n] and (type( arg ) in same_types or
+					type( arg ) in (int, long) and -small < arg < small):
+				continue
+			put_term( a0+i, arg )
+			last[n] = arg
+		self.__active = True
+		self.calls += 1
+		start = time.time()
+		qid = pl.PL_open_query( None, self.engine.Q_FLAGS, self.pred, a0 )
+		try:
+			next_solution = pl.PL_next_solution
+			if decode:
+				decode_vector = pl.decoder().decode_vector
+			while next_solution( qid ):
+				self.solutions += 1
+				self.seconds += time.time() - start
+				if decode:
+					yield decode_vector( a0, self.arity )
+				else:
+					yield self.terms
+				start = time.time()
+			check_exception( pl, qid )
+		finally:
+			pl.PL_close_query( qid )
+			self.seconds += time.time() - start
+			self.__active = False
+
+	def once( self, *args ):
+		"""Return tuple of decoded arguments of the first solution or
+		None if there is not any"""
+		for res in self( *args, decode=True ):
+			return res
+		return None
+
+	def stats( self ):
+		"""Return dictionary of counters: calls, solutions, seconds (spent
+		in SWI-Prolog) and mean (seconds per call)"""
+		return dict( calls=self.calls, solutions=self.solutions,
+			seconds=self.seconds,
+			mean=self.seconds/self.calls if self.calls else None )
+
+	def reset_stats( self ):
+		self.calls = self.solutions = 0
+		self.seconds = 0.0
+
+#----------------------------- Foreign predicates ------------------------------
+# foreign_t f( term_t t0, int arity, control_t context ) (PL_FA_VARARGS)
+PL_FOREIGN_VARARGS = CFUNCTYPE( c_size_t, c_size_t, c_int, c_void_p )
+
+class PlArg( PlTerm ):
+	"""Argument of predicate defined in Python (see
+	PlEngine.register_predicate()). It is PlTerm which is decoded lazily:
+	value is decoded on first access only"""
+	__slots__ = ('engine', '__value')
+
+	def __init__( self, engine, pl_term ):
+		PlObject.__init__( self, engine.pl )
+		self.engine = engine
+		self.num = 1
+		self.pl_term = pl_term
+		self.__value = self # not decoded yet
+
+	def _init_from_pl( self, pl_term, num=1 ):
+		PlTerm._init_from_pl( self, pl_term, num )
+		self.__value = self
+
+	@property
+	def value( self ):
+		"""Python data of argument (see PlDecoder)"""
+		if self.__value is self:
+			self.__value = self.pl.decoder().decode( self.pl_term )
+		return self.__value
+
+	def unify( self, obj ):
+		"""Unify argument with Python data obj (see PlEngine.put_term()).
+		Return True on success"""
+		pl = self.pl
+		t = pl.PL_new_term_ref()
+		self.engine.put_term( t, obj )
+		self.__value = self
+		return bool( pl.PL_unify( self.pl_term, t ) )
+
+def _foreign_trampoline( engine, func, arity, nondeterministic ):
+	"""Return C function (PL_FOREIGN_VARARGS) which calls Python func
+	with PlArg arguments. Predicate may be called by any thread: engine
+	is used by the registering thread, other threads get own
+	PlThreadEngine (PlUtils, decoder and tables are not shared)"""
+	local = threading.local()
+	local.engine = engine
+	active = {} # context -> (generator, arguments) of nondeterministic call
+	contexts = count( 1 )
+
+	def current():
+		"""Return engine of current thread"""
+		try:
+			return local.engine
+		except AttributeError:
+			local.engine = PlThreadEngine( engine )
+			return local.engine
+
+	def fail( eng, exc ):
+		"""Raise Prolog exception for Python exception exc"""
+		pl = eng.pl
+		if isinstance( exc, PlException ):
+			if pl.PL_exception( 0 ):
+				return 0 # passed by nested query already
+			term = exc.term
+		else:
+			term = ('error', ('python_error', type( exc ).__name__, str( exc )), None)
+		t = pl.PL_new_term_ref()
+		eng.put_term( t, term )
+		return pl.PL_raise_exception( t )
+
+	def deterministic( t0, ac, context ):
+		eng = current()
+		try:
+			return func( *[PlArg( eng, t0+i ) for i in range( arity )] ) is not False
+		except Exception as exc:
+			return fail( eng, exc )
+
+	def next_solution( gen ):
+		"""Step generator to the next solution: return True or False
+		(no more solutions)"""
+		for res in gen:
+			if res is not False:
+				return True
+		return False
+
+	def nondet( t0, ac, context ):
+		eng = current()
+		pl = eng.pl
+		control = pl.PL_foreign_control( context )
+		try:
+			if control == PL_FIRST_CALL:
+				args = [PlArg( eng, t0+i ) for i in range( arity )]
+				gen = iter( func( *args ) )
+				key = next( contexts )
+			else:
+				key = pl.PL_foreign_context( context )
+				gen, args = active.pop( key )
+				if control == PL_PRUNED:
+					gen.close()
+					return 1
+				for i, arg in enumerate( args ):
+					arg._init_from_pl( t0+i )
+			if next_solution( gen ):
+				active[key] = (gen, args)
+				return pl( '_PL_retry:size_t->size_t' )( key )
+			return 0
+		except Exception as exc:
+			return fail( eng, exc )
+
+	return PL_FOREIGN_VARARGS( nondet if nondeterministic else deterministic )
+
 #---------------------------- Factory of all above classes -----------------------------------
 def TermCons( cls, pl ):
 	"""Create class factory with pre-applied 1st argument (SWI-Prolog library)"""
@@ -493,8 +1769,62 @@ def TermCons( cls, pl ):
 #-------------------------------------- SWI ------------------------------------
 class PlEngine:
 	Q_FLAGS = PL_Q_CATCH_EXCEPTION # flags of query execution. Exceptions depends on they
+	# flags of query which passes exception to parent environment
+	Q_PASS_FLAGS = (Q_FLAGS & ~PL_Q_CATCH_EXCEPTION) | PL_Q_PASS_EXCEPTION
+	ASYNC_WORKERS = 4 # default number of threads for aquery()
+	BATCH_SECONDS = 0.02 # target time of one batch of query( ..., batch=N )
+	# keyword -> (command line option, minimal SWI-Prolog version,
+	# options of older versions: limit is an error if there are not)
+	LIMIT_OPTIONS = {
+		'stack_limit':('--stack-limit=%s', 70714, ('-G%s', '-L%s', '-T%s')),
+		'table_space':('--table-space=%s', 80000, ()),
+		}
 
-	def __init__( self, *args ):
+	def __init__( self, *args, **kw ):
+		"""args are SWI-Prolog command line arguments. Keywords are:
+		    atom_cache      size of atoms table (see PlAtomTable), None
+		                    is unlimited
+		    functor_cache   size of functors table (see PlFunctorTable)
+		    answer_cache    size of answers memo (see memoize())
+		    answer_ttl      seconds of life of memoized answers, None
+		                    is unlimited
+		    async_workers   number of threads for aquery()
+		    state           saved state (see save_state()) to boot from,
+		                    or .qlf file which is loaded after boot
+		    consult         list of files (sources or .qlf) to load
+		    lazy            bind DLL functions on first use (default),
+		                    False binds all functions at once
+		    stack_limit     limit of all stacks together, bytes or
+		                    string like '2g'. Before SWI-Prolog 7.7.14
+		                    it limits each of global, local and trail
+		                    stacks (-G, -L, -T)
+		    table_space     limit of tables space (SWI-Prolog 8+,
+		                    PlError is raised before)
+		    gc              False disables garbage collector
+		    profile         sample rate of DLL calls profiling, for
+		                    example 0.01 (see pl.stats()), default None
+		                    is off
+		Seconds of each phase of initialisation (dlopen, init, setup,
+		consult) are in dictionary init_times"""
+		start = time.time()
+		atom_cache = kw.pop( 'atom_cache', 4096 )
+		functor_cache = kw.pop( 'functor_cache', 1024 )
+		answer_cache = kw.pop( 'answer_cache', 1024 )
+		answer_ttl = kw.pop( 'answer_ttl', None )
+		self.async_workers = kw.pop( 'async_workers', self.ASYNC_WORKERS )
+		state = kw.pop( 'state', None )
+		consult = list( kw.pop( 'consult', () ) )
+		lazy = kw.pop( 'lazy', True )
+		limits = [(k, kw.pop( k, None )) for k in sorted( self.LIMIT_OPTIONS )]
+		limits = [(k, size_option( size )) for k, size in limits if size is not None]
+		gc = kw.pop( 'gc', None )
+		profile = kw.pop( 'profile', None )
+		if kw:
+			raise TypeError( 'unexpected keyword argument \'%s\''%kw.popitem()[0] )
+		if state and state.endswith( '.qlf' ):
+			consult.insert( 0, state )
+			state = None
+		times = self.init_times = {}
 		this_os = sys.platform.upper()
 		ARG0 = [dll for os,dll in OS_DEPEND_DLL if (os and os in this_os)] \
 			or OS_DEPEND_DLL[0]
@@ -502,25 +1832,67 @@ class PlEngine:
 		self.pl = None
 		try:
 			self.dll = CDLL( ARG0 )
-			self.pl = PlUtils( self.dll )
+			# one PlUtils for all objects of this engine. Lazy one
+			# binds each function on first use
+			self.pl = PlUtils( self.dll, eager=not lazy, profile=profile )
 		except:
 			raise PlError( 'DLL \'%s\' not found'%ARG0 )
-		pl_args = [ARG0, '-q'] + list( args ) + [c_char_p()]
+		times['dlopen'] = time.time() - start
+		self.version = self.pl.PL_query( PL_QUERY_VERSION )
+		options = []
+		for k, size in limits:
+			option, version, old_options = self.LIMIT_OPTIONS[k]
+			if self.version >= version:
+				options.append( option%size )
+			elif old_options:
+				options.extend( o%size for o in old_options )
+			else:
+				self.pl = None # not initialised: __del__() must not halt
+				raise PlError( '%s needs SWI-Prolog %d.%d.%d or later'%(k,
+					version//10000, version//100%100, version%100) )
+		# -x must be the first option
+		pl_args = [ARG0] + (['-x', state] if state else []) + ['-q'] + \
+			options + list( args ) + [c_char_p()]
 		Argv = c_char_p * len( pl_args )
 		pl_args_count = len( pl_args ) - 1 # without terminated NULL
 		pl_args = Argv( *pl_args )
 		# initialisation of SWI PL
+		start = time.time()
 		if not self.pl.PL_initialise( pl_args_count, byref( pl_args ) ):
 			self.pl.PL_halt(0)
 			raise PlError( 'Initialise error' )
-		else:
-			# Factories. For example, if term=='PlAtom', then PlEngine will
-			# has field 'Atom' which create PlAtom object with pre-setted
-			# SWI-Prolog library ('obj.pl')
-			for term in ('PlUtils','PlTerm','PlAtom','PlFunctor'):
-				# cutting 'Pl' in begining of term. All factories will be
-				# available without 'Pl' prefix
-				setattr( self, term[2:], TermCons( globals()[term], self.pl ) )
+		times['init'] = time.time() - start
+		start = time.time()
+		self._setup( atom_cache, functor_cache,
+			PlAnswerCache( answer_cache, answer_ttl ) )
+		if gc is not None:
+			self.__call( 'system:set_prolog_flag', 'gc', bool( gc ) )
+		times['setup'] = time.time() - start
+		start = time.time()
+		for path in consult:
+			self.consult( path )
+		times['consult'] = time.time() - start
+
+	def _setup( self, atom_cache, functor_cache, answers ):
+		"""Create Python side of the engine: factories, caches and
+		tables (SWI-Prolog is initialised already). answers is
+		PlAnswerCache shared by engines of process"""
+		self.__preds = {} # (module, name, arity) -> predicate_t
+		# Factories. For example, if term=='PlAtom', then PlEngine will
+		# has field 'Atom' which create PlAtom object with pre-setted
+		# SWI-Prolog library ('obj.pl')
+		for term in ('PlUtils','PlTerm','PlAtom','PlFunctor'):
+			# cutting 'Pl' in begining of term. All factories will be
+			# available without 'Pl' prefix
+			setattr( self, term[2:], TermCons( globals()[term], self.pl ) )
+		# interned atoms and functors
+		self.atoms = PlAtomTable( self.pl, atom_cache )
+		self.functors = PlFunctorTable( self.pl, self.atoms, functor_cache )
+		self.answers = answers
+		self.__async_executor = None # see aquery()
+		self.__helpers = set() # (name, arity) of defined helpers
+		self.__foreign = {} # (module, name, arity) -> trampoline
+		self.__findnsols = None # findnsols/4 is defined, see query()
 
 	def __del__( self ):
 		if self.pl:
@@ -539,8 +1911,1105 @@ class PlEngine:
 			term = t
 		return (mod, term)
 
+	def frame( self ):
+		"""Return new PlFrame (context manager, opened on entering)"""
+		return PlFrame( self.pl )
+
+	def atom( self, chars ):
+		"""Return PlAtom for chars (str or unicode) from atoms
+		table. It is locked while PlAtom is alive"""
+		a = PlAtom( self.pl, None )
+		a._init_from_pl( self.atoms[chars], chars, register=True )
+		return a
+
+	def functor( self, name, arity ):
+		"""Return PlFunctor for name (str or unicode) and arity
+		from functors table"""
+		f = PlFunctor( self.pl, None, arity )
+		f._init_from_pl( self.functors[(name, arity)], name, arity )
+		return f
+
+	def helper( self, name, arity, clauses ):
+		"""Return predicate_t of helper predicate user:name/arity. It is
+		defined by clauses (texts) on first use, if it is not defined
+		in SWI-Prolog yet (by other engine, for example). Check and
+		definition run under one Prolog mutex, so threads which use the
+		helper at once define it once"""
+		pred = self.predicate( name, arity )
+		if (name, arity) in self.__helpers:
+			return pred
+		goal = 'with_mutex(\'$swipl_helpers\', (current_predicate(user:\'%s\'/%d) ' \
+			'-> true ; %s))'%(name, arity,
+			', '.join( ['assertz(user:(%s))'%c for c in clauses] ))
+		pl = self.pl
+		t = pl.PL_new_term_ref()
+		try:
+			if not pl.PL_chars_to_term( goal, t ) or not pl.PL_call( t, None ):
+				check_exception( pl )
+				raise PlError( 'can not define helper %s/%d'%(name, arity) )
+		finally:
+			pl.PL_reset_term_refs( t )
+		self.__helpers.add( (name, arity) )
+		return pred
+
+	def predicate( self, name, arity, module='user' ):
+		"""Return SWI-Prolog predicate handle (predicate_t). Handles
+		are cached, so PL_predicate() is called once for each
+		(module, name, arity)"""
+		key = (module, name, arity)
+		try:
+			return self.__preds[key]
+		except KeyError:
+			pred = self.__preds[key] = self.pl.PL_predicate( name, arity, module )
+			return pred
+
+	def query( self, goal, *args, **kw ):
+		"""Generator of goal solutions. goal is predicate name,
+		may be with module: 'member', 'lists:member'. args are goal
+		arguments: PlTerm or any object for PlTerm.put() (None is
+		fresh variable), arity of predicate is len(args).
+		Yields PlTermVector of arguments (with num=len(args))
+		bound by the solution: it is valid until the next solution.
+		Arguments are put by put_term(), so strings are atoms.
+		If keyword decode=True, yields tuple of decoded arguments
+		(see decode()) instead of PlTerm. Answers of predicates registered
+		by memoize() are taken from answers memo then.
+		Exception of goal is raised as PlException (see
+		exception_from_term()). If keyword pass_exception=True, it is
+		passed to parent Prolog environment too (PL_Q_PASS_EXCEPTION),
+		this is for queries from predicates defined in Python.
+		If keyword batch=N, solutions are collected by Prolog in lists of
+		up to N (findnsols/4), each list is got and decoded at once, so
+		decoded solutions are yielded (as with decode=True). Size of
+		lists adapts to time of answers: one list takes about
+		BATCH_SECONDS. PlError is raised if SWI-Prolog has not
+		findnsols/4 (before 7).
+		Query is cut when generator is exhausted, closed or
+		garbage-collected. Then term handles of arguments and handles
+		created while iterating (PlTerm, new_term_ref()) are released
+		(query runs in foreign frame). Only innermost query can be active,
+		so nested query must be closed before next solution of outer one.
+		Typical use is:
+		    for t in pleng.query( 'lists:member', None, [1,2,3] ):
+		        ...
+		"""
+		decode = kw.pop( 'decode', False )
+		flags = self.Q_PASS_FLAGS if kw.pop( 'pass_exception', False ) else self.Q_FLAGS
+		batch = kw.pop( 'batch', None )
+		if kw:
+			raise TypeError( 'unexpected keyword argument \'%s\''%kw.popitem()[0] )
+		mod, name = self.__scope( goal )
+		arity = len( args )
+		if batch is not None:
+			if batch < 1:
+				raise ValueError( 'batch must be positive' )
+			if self.__findnsols is None:
+				self.__findnsols = self.__defined( 'findnsols', 4 )
+			if not self.__findnsols:
+				raise PlError( 'batch needs findnsols/4 (SWI-Prolog 7 or later)' )
+			return self.__query_batched( mod, name, args, batch, flags )
+		if decode and flags == self.Q_FLAGS and (mod, name, arity) in self.answers:
+			try:
+				key = answer_key( args )
+			except TypeError:
+				pass # PlTerm arguments, for example
+			else:
+				return self.__memo_query( (mod, name, arity), key, args )
+		return self.__query( mod, name, args, decode, flags )
+
+	def __defined( self, name, arity ):
+		"""True if predicate name/arity is defined in module system"""
+		try:
+			self.__call( 'system:predicate_property',
+				(name,) + (None,)*arity, 'defined' )
+		except PlError:
+			return False
+		return True
+
+	def __memo_query( self, pred, key, args ):
+		"""Generator of memoized answers: as __query(), it is lazy (the
+		query runs on the first next()) and has close()"""
+		for answer in self.__memo_answers( pred, key, args ):
+			yield answer
+
+	def __memo_answers( self, pred, key, args ):
+		answers = self.answers.get( pred, key )
+		if answers is None:
+			mod, name, arity = pred
+			answers = list( self.__query( mod, name, args, True, self.Q_FLAGS ) )
+			self.answers.put( pred, key, answers )
+		return answers
+
+	def __query( self, mod, name, args, decode, flags ):
+		arity = len( args )
+		pred = self.predicate( name, arity, mod )
+		pl = self.pl
+		# argument handles (and handles created by caller while
+		# iterating) are released with the frame when query is finished
+		fid = pl.PL_open_foreign_frame()
+		try:
+			a0 = pl.PL_new_term_refs( arity ) if arity else 0
+			for i, arg in enumerate( args ):
+				self.put_term( a0+i, arg )
+			terms = PlTermVector( pl, 0 )
+			terms._init_from_pl( a0, arity )
+			qid = pl.PL_open_query( None, flags, pred, a0 )
+			try:
+				next_solution = pl.PL_next_solution
+				if decode:
+					decode_vector = pl.decoder().decode_vector
+					while next_solution( qid ):
+						yield decode_vector( a0, arity )
+				else:
+					while next_solution( qid ):
+						yield terms
+				check_exception( pl, qid )
+			finally:
+				pl.PL_cut_query( qid )
+		finally:
+			pl.PL_close_foreign_frame( fid )
+
+	def __query_batched( self, mod, name, args, batch, flags ):
+		pl = self.pl
+		pred = self.helper( '$swipl_findnsols', 4, [
+			'\'$swipl_findnsols\'(N, T, G, L) :- findnsols(N, T, G, L)'] )
+		fid = pl.PL_open_foreign_frame()
+		try:
+			# count(N), template G, M:G, list, M, G
+			q = pl.PL_new_term_refs( 6 )
+			size = batch
+			self.put_term( q, ('count', size) )
+			self.put_term( q+1, (name,) + args )
+			self.put_term( q+4, mod )
+			pl.PL_put_term( q+5, q+1 )
+			if not pl.PL_cons_functor_v( q+2, self.functors[(':', 2)], q+4 ):
+				stack_error( pl )
+			# arguments of nb_setarg(1, count(N), Size)
+			s = pl.PL_new_term_refs( 3 )
+			self.put_term( s, 1 )
+			pl.PL_put_term( s+1, q )
+			setarg = self.predicate( 'nb_setarg', 3, 'system' )
+			decode = pl.decoder().decode
+			qid = pl.PL_open_query( None, flags, pred, q )
+			try:
+				next_solution = pl.PL_next_solution
+				while True:
+					start = time.time()
+					if not next_solution( qid ):
+						break
+					answers = decode( q+3 )
+					seconds = time.time() - start
+					for answer in answers:
+						yield answer[1:] if type( answer ) == tuple else ()
+					if len( answers ) < size:
+						break # the last list
+					# size for BATCH_SECONDS, it is changed if it differs twice
+					new_size = max( 1, min( batch, int( self.BATCH_SECONDS*size/seconds )
+						if seconds else batch ) )
+					if new_size*2 <= size or new_size >= size*2:
+						size = new_size
+						if not pl.PL_put_int64( s+2, size ):
+							stack_error( pl )
+						if not pl.PL_call_predicate( None, self.Q_PASS_FLAGS, setarg, s ):
+							check_exception( pl )
+				check_exception( pl, qid )
+			finally:
+				pl.PL_cut_query( qid )
+		finally:
+			pl.PL_close_foreign_frame( fid )
+
+	def consult( self, path ):
+		"""Load source or .qlf file path into module user"""
+		self.__call( 'system:consult', path )
+
+	def save_state( self, path, consult=() ):
+		"""Load files consult and save state of SWI-Prolog into path, for
+		fast start by PlEngine( state=path ). If path ends with '.qlf',
+		consult must be one file: it (with files it loads) is compiled
+		into quick load file path instead (see qcompile/1)"""
+		consult = list( consult )
+		if path.endswith( '.qlf' ):
+			if len( consult ) != 1:
+				raise ValueError( '.qlf is compiled from one file' )
+			src = consult[0]
+			self.__call( 'system:qcompile', src )
+			qlf = os.path.splitext( src )[0] + '.qlf'
+			if os.path.abspath( qlf ) != os.path.abspath( path ):
+				if os.path.exists( path ):
+					os.remove( path )
+				os.rename( qlf, path )
+		else:
+			for src in consult:
+				self.consult( src )
+			self.__call( 'system:qsave_program', path, [] )
+		return path
+
+	def stats( self ):
+		"""Return dictionary of resource usage by one helper call of
+		statistics/2 (cheap enough for polling): bytes of stacks (stack,
+		globalused, localused, trailused, stack_limit), atoms, functors,
+		gc_runs, gc_freed (bytes), gc_time (seconds), inferences, cputime
+		(seconds). Keys unknown to this version of SWI-Prolog are absent"""
+		self.helper( '$swipl_stats', 1, [
+			'\'$swipl_stats\'(L) :- findall(K-V, (member(K, [stack, globalused, '
+			'localused, trailused, stack_limit, atoms, functors, inferences, '
+			'cputime, garbage_collection]), catch(statistics(K, V), _, fail)), L)'] )
+		stats = {}
+		with self.frame():
+			for (res,) in self.query( '$swipl_stats', None, decode=True ):
+				for _, key, value in res:
+					if key == 'garbage_collection':
+						stats['gc_runs'], stats['gc_freed'], ms = value[:3]
+						stats['gc_time'] = ms/1000.0
+					else:
+						stats[key] = value
+		return stats
+
+	def __call( self, goal, *args ):
+		"""Call goal once, raise PlError if it fails"""
+		with self.frame():
+			solutions = self.query( goal, *args )
+			try:
+				for _ in solutions:
+					return
+			finally:
+				# query must be closed before its frame
+				solutions.close()
+		raise PlError( '%s/%d failed'%(goal, len(args)) )
+
+	def register_predicate( self, name, arity, func, nondeterministic=False ):
+		"""Define predicate name/arity (name may be with module) by
+		Python func. func is called with arity PlArg arguments: decoded
+		by its value property (lazily), bound by unify(). Predicate fails
+		if func returns False, else it succeeds. If nondeterministic is
+		True, func returns iterable (generator) and each its item is
+		solution (False items are skipped); bindings are undone by Prolog
+		on backtracking. Python exception is raised in Prolog as
+		error(python_error(Type, Message), _), PlException as its term.
+		Predicate may be called by any thread: engine of PlArg is engine
+		of calling thread (use it for nested queries). One C trampoline
+		(PL_FA_VARARGS) is made for predicate and kept while engine lives"""
+		mod, pname = self.__scope( name )
+		cfunc = _foreign_trampoline( self, func, arity, nondeterministic )
+		flags = PL_FA_VARARGS | (PL_FA_NONDETERMINISTIC if nondeterministic else 0)
+		if not self.pl.PL_register_foreign_in_module( mod, pname, arity,
+				cast( cfunc, c_void_p ), flags ):
+			raise PlError( 'can not register predicate %s/%d'%(name, arity) )
+		self.__foreign[(mod, pname, arity)] = cfunc
+
+	def memoize( self, goal, arity, depends=() ):
+		"""Memoize answers of goal/arity (goal is predicate name, may be
+		with module) for query( ..., decode=True ). Answers are keyed by
+		arguments (see answer_key()), all solutions are collected on miss,
+		so predicate must be pure and finite. depends are predicates
+		(name, arity) which clauses answers depend on: answers are dropped
+		when assert_many() or retractall() changes them or predicate itself.
+		Change database by other ways must be followed by invalidate().
+		Memo (see PlEngine.answers) is shared by all engines of process
+		(PlThreadEngine of threads and of PlEnginePool)"""
+		self.answers.add( self.__indicator( goal, arity ),
+			[self.__indicator( g, a ) for g, a in depends] )
+
+	def invalidate( self, goal=None, arity=None ):
+		"""Drop memoized answers which depend on goal/arity (all if goal
+		is None)"""
+		self.answers.invalidate( None if goal is None else
+			self.__indicator( goal, arity ) )
+
+	def retractall( self, goal, *args ):
+		"""Remove all clauses which heads unify with goal(args...) (see
+		query() for goal and args) and drop memoized answers which depend
+		on them"""
+		mod, name = self.__scope( goal )
+		with self.frame():
+			q = self.to_term( (':', mod, (name,) + args) )
+			if not self.pl.PL_call_predicate( None, self.Q_PASS_FLAGS,
+					self.predicate( 'retractall', 1, 'system' ), q.pl_term ):
+				check_exception( self.pl )
+				raise PlError( 'can not retract %s/%d'%(name, len(args)) )
+		self.answers.invalidate( (mod, name, len(args)) )
+
+	def __indicator( self, goal, arity ):
+		"""Return (module, name, arity) of goal"""
+		mod, name = self.__scope( goal )
+		return (mod, name, arity)
+
+	def prepare( self, goal, arity=None ):
+		"""Return PlGoal for goal template. goal is text of goal where
+		atom ? marks arguments which are passed on call, for example
+		'lists:member(X, ?)'. Variables and other arguments are fixed.
+		If arity is given, goal is predicate name (may be with module),
+		and all arity arguments are passed on call:
+		    member = pleng.prepare( 'lists:member', 2 )
+		    for x, l in member( None, [1,2,3], decode=True ):
+		        ...
+		Term handles of PlGoal live while SWI-Prolog engine lives, so
+		prepare goals outside of foreign frames"""
+		pl = self.pl
+		if arity is not None:
+			mod, name = self.__scope( goal )
+			a0 = pl.PL_new_term_refs( arity ) if arity else 0
+			return PlGoal( self, self.predicate( name, arity, mod ),
+				a0, arity, list( range( arity ) ), goal )
+		# parsed goal is kept: its handles are below argument vector
+		t = pl.PL_new_term_refs( 2 )
+		if not pl.PL_chars_to_term( goal, t ):
+			raise PlError( 'syntax error in goal %r'%goal )
+		functor = pl.ctype( 'functor_t' )()
+		mod = 'user'
+		pl.PL_get_functor( t, byref( functor ) )
+		if functor.value == self.functors[(':', 2)]:
+			pl.PL_get_arg( 1, t, t+1 )
+			mod = pl.decoder().decode( t+1 )
+			pl.PL_get_arg( 2, t, t )
+		if not pl.PL_get_functor( t, byref( functor ) ):
+			raise PlError( 'goal %r is not callable'%goal )
+		name = pl.PL_atom_chars( pl.PL_functor_name( functor.value ) )
+		arity = pl.PL_functor_arity( functor.value )
+		a0 = pl.PL_new_term_refs( arity ) if arity else 0
+		hole = self.atoms['?']
+		holes = []
+		atom = pl.ctype( 'atom_t' )()
+		for i in range( arity ):
+			pl.PL_get_arg( i+1, t, a0+i )
+			if pl.PL_get_atom( a0+i, byref( atom ) ) and atom.value == hole:
+				holes.append( i )
+		return PlGoal( self, self.predicate( name, arity, mod ), a0, arity, holes, goal )
+
+	def decode( self, terms ):
+		"""Return Python data for PlTerm (see PlDecoder). If terms is
+		vector, return tuple of data for all its terms"""
+		return terms.to_python()
+
+	def aquery( self, goal, *args, **kw ):
+		"""Asynchronous variant of query() for asyncio: return
+		asynchronous iterator of solutions (tuples of decoded arguments):
+		    async for x, l in pleng.aquery( 'lists:member', None, [1,2] ):
+		        ...
+		Query is executed by one of async_workers threads, each with own
+		SWI-Prolog engine, so at most async_workers queries run at once
+		(others wait) and event loop is never blocked. Keyword timeout
+		(seconds) limits the whole query: asyncio.TimeoutError is raised
+		on the next step after it. Cancellation of awaiting task, timeout
+		and aclose() cut the query (when its current step is finished)"""
+		timeout = kw.pop( 'timeout', None )
+		if kw:
+			raise TypeError( 'unexpected keyword argument \'%s\''%kw.popitem()[0] )
+		if self.__async_executor is None:
+			self.__async_executor = PlAsyncExecutor( self, self.async_workers )
+		return PlAsyncQuery( self.__async_executor, goal, args, timeout )
+
+	def assert_many( self, name, rows, module='user', chunk=1000, bulk=False, columns=False ):
+		"""Add facts name(...) to the end of database of module. rows is
+		iterable of tuples of fact arguments (see put_term()) or, if
+		columns is True, sequence of columns (sequences of arguments).
+		Rows are read lazily by chunks: terms of each chunk are built in
+		one reused vector of term handles within one foreign frame. If bulk
+		is True, chunk is passed to SWI-Prolog as one list and asserted by
+		helper predicate, so there is one call per chunk.
+		Return dictionary: number of facts, chunks, seconds and rate (facts
+		per second)"""
+		if chunk < 1:
+			raise ValueError( 'chunk must be positive' )
+		if columns:
+			rows = izip( *rows )
+		rows = iter( rows )
+		pl = self.pl
+		put_term = self.put_term
+		cons_functor_v = pl.PL_cons_functor_v
+		call_predicate = pl.PL_call_predicate
+		flags = self.Q_PASS_FLAGS # exception is read by check_exception()
+		if bulk:
+			pred = self.helper( '$swipl_assertz_all', 2, [
+				'\'$swipl_assertz_all\'(M, L) :- forall(member(F, L), assertz(M:F))'] )
+		else:
+			pred = self.predicate( 'assertz', 1, 'system' )
+		colon = self.functors[(':', 2)]
+		nfacts = nchunks = 0
+		start = time.time()
+		while True:
+			block = list( islice( rows, chunk ) )
+			if not block:
+				break
+			arity = len( block[0] )
+			functor = self.functors[(name, arity)]
+			with self.frame():
+				a0 = pl.PL_new_term_refs( arity ) if arity else 0
+				q = pl.PL_new_term_refs( 2 ) # module, fact (or list of facts)
+				put_term( q, module )
+				fact = q + 1
+				if bulk:
+					h = pl.PL_new_term_ref()
+					pl.PL_put_nil( fact )
+					for row in reversed( block ):
+						self.__put_row( a0, arity, row )
+						if not (cons_functor_v( h, functor, a0 ) and
+								pl.PL_cons_list( fact, h, fact )):
+							stack_error( pl )
+					if not call_predicate( None, flags, pred, q ):
+						check_exception( pl )
+						raise PlError( 'can not assert facts %s/%d'%(name, arity) )
+				else:
+					clause = pl.PL_new_term_ref()
+					for row in block:
+						self.__put_row( a0, arity, row )
+						if not (cons_functor_v( fact, functor, a0 ) and
+								cons_functor_v( clause, colon, q )):
+							stack_error( pl )
+						if not call_predicate( None, flags, pred, clause ):
+							check_exception( pl )
+							raise PlError( 'can not assert fact %s/%d'%(name, arity) )
+			self.answers.invalidate( (module, name, arity) )
+			nfacts += len( block )
+			nchunks += 1
+		seconds = time.time() - start
+		return dict( facts=nfacts, chunks=nchunks, seconds=seconds,
+			rate=nfacts/seconds if seconds else None )
+
+	def __put_row( self, a0, arity, row ):
+		"""Put tuple row into vector a0 of arity term handles"""
+		if len( row ) != arity:
+			raise ValueError( 'all rows must have %d items'%arity )
+		put_term = self.put_term
+		for i in range( arity ):
+			put_term( a0+i, row[i] )
+
+	def put_array( self, pl_term, seq, kind=None, via_file=False ):
+		"""Put list of numbers from seq into term handle pl_term (see
+		PlTerm.put_array()). If via_file is True, numbers are passed as
+		text through temporary file which is read by one helper predicate
+		call (one foreign call instead of two per item). Infinite and NaN
+		floats are not passed then (ValueError). Which way is faster
+		depends on the system: compare array.* cases of plbench"""
+		if not via_file:
+			t = PlTerm( self.pl, 0 )
+			t._init_from_pl( pl_term )
+			t.put_array( seq, kind )
+			return
+		import tempfile
+		seq = numeric_array( seq, kind )
+		fmt = repr if seq.typecode in 'fd' else str
+		text = ','.join( map( fmt, seq ) )
+		# only inf and nan have 'n': Prolog would read them as atoms
+		if 'n' in text:
+			raise ValueError( 'infinite or NaN number in arg 2' )
+		fd, path = tempfile.mkstemp( prefix='swipl', suffix='.pl' )
+		try:
+			with os.fdopen( fd, 'w' ) as f:
+				f.write( '[' )
+				f.write( text )
+				f.write( '].\n' )
+			pred = self.helper( '$swipl_read_numbers', 2, [
+				'\'$swipl_read_numbers\'(F, L) :- '
+				'setup_call_cleanup(open(F, read, S), read(S, L), close(S))'] )
+			self.__call_numbers( pred, path, pl_term, True )
+		finally:
+			os.remove( path )
+
+	def get_array( self, pl_term, kind='d', via_file=False ):
+		"""Return array.array of numbers of Prolog list pl_term (see
+		PlTerm.get_array()). If via_file is True, the list is written by
+		one helper predicate call into temporary file, which is parsed
+		line by line"""
+		if not via_file:
+			t = PlTerm( self.pl, 0 )
+			t._init_from_pl( pl_term )
+			return t.get_array( kind )
+		import tempfile
+		fd, path = tempfile.mkstemp( prefix='swipl', suffix='.txt' )
+		os.close( fd )
+		try:
+			pred = self.helper( '$swipl_write_numbers', 2, [
+				'\'$swipl_write_numbers\'(F, L) :- is_list(L), '
+				'setup_call_cleanup(open(F, write, S), '
+				'forall(member(X, L), (number(X), write(S, X), nl(S))), close(S))'] )
+			self.__call_numbers( pred, path, pl_term, False )
+			conv = _float_text if kind in 'fd' else int
+			with open( path ) as f:
+				return array.array( kind, map( conv, f ) )
+		finally:
+			os.remove( path )
+
+	def __call_numbers( self, pred, path, pl_term, read ):
+		"""Call helper pred(path, List) for put_array()/get_array()"""
+		pl = self.pl
+		with self.frame():
+			q = pl.PL_new_term_refs( 2 )
+			self.put_term( q, path )
+			if not read:
+				pl.PL_put_term( q+1, pl_term )
+			if not pl.PL_call_predicate( None, self.Q_PASS_FLAGS, pred, q ):
+				check_exception( pl )
+				raise PlError( 'can not pass numbers through %s'%path )
+			if read:
+				pl.PL_put_term( pl_term, q+1 )
+
+	def record( self, obj ):
+		"""Return PlRecord of PlTerm or Python data obj (see put_term())"""
+		if isinstance( obj, PlTerm ):
+			return PlRecord( self.pl, obj.pl_term )
+		with self.frame():
+			return PlRecord( self.pl, self.to_term( obj ).pl_term )
+
+	def recorded( self, record ):
+		"""Return new PlTerm with copy of term of PlRecord record"""
+		return record.term()
+
+	def record_external( self, obj ):
+		"""Return bytes with external representation (PL_record_external())
+		of PlTerm or Python data obj. It may be stored or sent to other
+		process and instantiated by recorded_external() there"""
+		pl = self.pl
+		size = c_size_t()
+		with self.frame():
+			t = obj if isinstance( obj, PlTerm ) else self.to_term( obj )
+			data = pl.PL_record_external( t.pl_term, byref( size ) )
+		if not data:
+			raise PlError( 'can not record term' )
+		try:
+			return string_at( data, size.value )
+		finally:
+			pl.PL_erase_external( data )
+
+	def recorded_external( self, data, pl_term=None ):
+		"""Return new PlTerm with term of external record data (bytes or
+		buffer, see record_external()). If term handle pl_term is given,
+		term is put in it and None is returned"""
+		t = None
+		if pl_term is None:
+			t = PlTerm( self.pl )
+			pl_term = t.pl_term
+		ptr, size = buffer_data( data )
+		if not self.pl.PL_recorded_external( ptr, pl_term ):
+			raise PlError( 'invalid external record' )
+		return t
+
+	def term_vector( self, seq ):
+		"""Create new PlTermVector with terms from Python data of
+		sequence seq (see put_term())"""
+		vec = PlTermVector( self.pl, 0 )
+		vec._init_from_pl( self.pl.PL_new_term_refs( len( seq ) ) if seq else 0, len( seq ) )
+		vec.put( seq, self.put_term )
+		return vec
+
+	def to_term( self, obj ):
+		"""Create new PlTerm from Python data (see put_term())"""
+		t = PlTerm( self.pl )
+		self.put_term( t.pl_term, obj )
+		return t
+
+	def put_term( self, pl_term, obj ):
+		"""Put Python data obj into SWI-Prolog term handle pl_term.
+		Nested data is built in one pass:
+		    PlTerm              the same term
+		    PlAtom, PlFunctor   see PlTerm.put()
+		    None                fresh variable
+		    True/False          atoms true/false
+		    int, long           integer (big integer too)
+		    float               float
+		    str, unicode        atom
+		    bytearray, buffer   string (memoryview, mmap, Python 3 bytes
+		                        too), data are not copied by Python
+		    [...]               list
+		    ('f',a1,...,aN)     compound f(a1,...,aN); ('f',) is atom f
+		    {k:v,...}           list of pairs [k-v,...]
+		Arguments of compounds and list elements are built in scratch
+		term handles which are reset after use"""
+		putter = self.__putters.get( type(obj) )
+		if putter:
+			putter( self, pl_term, obj )
+		else:
+			self.__put_other( pl_term, obj )
+
+	def __put_variable( self, pl_term, obj ):
+		self.pl.PL_put_variable( pl_term )
+
+	def __put_bool( self, pl_term, obj ):
+		self.pl.PL_put_atom_chars( pl_term, 'true' if obj else 'false' )
+
+	def __put_int( self, pl_term, obj ):
+		if -0x8000000000000000 <= obj <= 0x7fffffffffffffff:
+			if not self.pl.PL_put_int64( pl_term, obj ):
+				stack_error( self.pl )
+		elif not self.pl.PL_chars_to_term( str(obj), pl_term ):
+			raise PlError( 'can not create integer %d'%obj )
+
+	def __put_float( self, pl_term, obj ):
+		if not self.pl.PL_put_float( pl_term, obj ):
+			stack_error( self.pl )
+
+	def __put_atom( self, pl_term, obj ):
+		self.pl.PL_put_atom( pl_term, self.atoms[obj] )
+
+	def __put_bytes( self, pl_term, obj ):
+		"""Put binary data as Prolog string without Python-side copy"""
+		data, size = buffer_data( obj )
+		self.pl.PL_put_string_nchars( pl_term, size, data )
+
+	def __put_list( self, pl_term, obj ):
+		pl = self.pl
+		pl.PL_put_nil( pl_term )
+		if obj:
+			h = pl.PL_new_term_ref()
+			put_term = self.put_term
+			cons_list = pl.PL_cons_list
+			for el in reversed( obj ):
+				put_term( h, el )
+				if not cons_list( pl_term, h, pl_term ):
+					stack_error( pl )
+			pl.PL_reset_term_refs( h )
+
+	def __put_compound( self, pl_term, obj ):
+		if not obj:
+			raise ValueError( 'compound can not be empty tuple' )
+		arity = len( obj ) - 1
+		if arity == 0:
+			self.put_term( pl_term, obj[0] )
+			return
+		pl = self.pl
+		a0 = pl.PL_new_term_refs( arity )
+		put_term = self.put_term
+		for i in range( arity ):
+			put_term( a0+i, obj[i+1] )
+		if not pl.PL_cons_functor_v( pl_term, self.__functor( obj[0], arity ), a0 ):
+			stack_error( pl )
+		pl.PL_reset_term_refs( a0 )
+
+	def __put_dict( self, pl_term, obj ):
+		self.__put_list( pl_term, [('-', k, v) for k, v in obj.items()] )
+
+	def __put_other( self, pl_term, obj ):
+		"""Put objects of subclasses and Pl-classes"""
+		if isinstance( obj, PlTerm ):
+			self.pl.PL_put_term( pl_term, obj.pl_term )
+		elif isinstance( obj, PlAtom ):
+			self.pl.PL_put_atom( pl_term, obj.pl_atom )
+		elif isinstance( obj, PlFunctor ):
+			self.pl.PL_put_functor( pl_term, obj.pl_functor )
+		else:
+			for tp in (bool, int, long, float, str, unicode, bytearray, list, tuple, dict):
+				if isinstance( obj, tp ):
+					self.__putters[tp]( self, pl_term, obj )
+					return
+			raise TypeError( 'can not put %s into term'%type(obj).__name__ )
+
+	def __functor( self, name, arity ):
+		"""Return functor_t for name (string or PlAtom) and arity"""
+		if isinstance( name, PlAtom ):
+			return self.pl.PL_new_functor( name.pl_atom, arity )
+		return self.functors[(name, arity)]
+
+	# type -> function for put_term(). Subclasses of these types and
+	# other classes are handled by __put_other(). Binary data (buffers
+	# and Python 3 bytes) become Prolog strings
+	__putters = {
+		bytes:__put_bytes,
+		bytearray:__put_bytes,
+		buffer:__put_bytes,
+		memoryview:__put_bytes,
+		mmap.mmap:__put_bytes,
+		type(None):__put_variable,
+		bool:__put_bool,
+		int:__put_int,
+		long:__put_int,
+		float:__put_float,
+		str:__put_atom,
+		unicode:__put_atom,
+		list:__put_list,
+		tuple:__put_compound,
+		dict:__put_dict,
+		}
+
+#-------------------------------------- Threads ------------------------------------
+class PlThreadEngine( PlEngine ):
+	"""Python side of SWI-Prolog engine which is used by current thread
+	(engine of PlEnginePool). It shares DLL with main PlEngine but has
+	own PlUtils, caches and tables, so engines of different threads
+	do not share any mutable state except locked memo of answers (see
+	memoize()). It does not initialise and does not halt SWI-Prolog"""
+
+	def __init__( self, main ):
+		"""main is PlEngine which initialised SWI-Prolog (or other
+		PlThreadEngine)"""
+		start = time.time()
+		self.dll = main.dll
+		self.pl = PlUtils( self.dll, eager=True )
+		self.version = main.version
+		self.async_workers = main.async_workers
+		self._setup( main.atoms.maxsize, main.functors.maxsize, main.answers )
+		self.init_times = {'setup':time.time() - start}
+
+	def __del__( self ):
+		pass
+
+def attach_thread( main ):
+	"""Return PlThreadEngine for current thread: SWI-Prolog engine is
+	created for it (PL_thread_attach_engine()) if thread has not any.
+	main is PlEngine which initialised SWI-Prolog"""
+	pl = main.pl
+	if pl.PL_thread_self() == -1 and pl.PL_thread_attach_engine( None ) < 0:
+		raise PlError( 'can not attach engine to thread' )
+	return PlThreadEngine( main )
+
+class PlEnginePool:
+	"""Pool of SWI-Prolog engines for multi-threaded programs. SWI-Prolog
+	is initialised once by main PlEngine (with args and keywords of pool),
+	then size engines are created by PL_create_engine(). Any thread takes
+	free engine by context manager (and waits while all are busy):
+	    pool = PlEnginePool( 4 )
+	    ...
+	    with pool.engine() as eng:
+	        for t in eng.query( ... ):
+	            ...
+	Long-living threads can use own engine instead (see attached()).
+	SWI-Prolog must support threads. DLL functions are called by ctypes
+	with released GIL, so long PL_next_solution() calls of different
+	engines run in parallel"""
+
+	def __init__( self, size, *args, **kw ):
+		if size < 1:
+			raise ValueError( 'arg 1 must be positive' )
+		self.main = PlEngine( *args, **kw )
+		self.__engines = [] # PL_engine_t
+		self.__free = queue.Queue() # (PL_engine_t, PlThreadEngine)
+		self.__local = threading.local()
+		for i in range( size ):
+			handle = self.main.pl.PL_create_engine( None )
+			if not handle:
+				self.close()
+				raise PlError( 'can not create engine' )
+			self.__engines.append( handle )
+			self.__free.put( (handle, PlThreadEngine( self.main )) )
+
+	def __len__( self ):
+		return len( self.__engines )
+
+	@contextmanager
+	def engine( self, timeout=None ):
+		"""Context manager: take free engine, set it to current thread
+		and return its PlThreadEngine. On exit previous engine of thread
+		is restored and engine returns to pool. Wait for free engine
+		while timeout (seconds, None is forever), then raise PlError"""
+		try:
+			handle, eng = self.__free.get( True, timeout )
+		except queue.Empty:
+			raise PlError( 'no free engine' )
+		try:
+			old = c_void_p()
+			rc = eng.pl.PL_set_engine( handle, byref(old) )
+			if rc != PL_ENGINE_SET:
+				raise PlError( 'can not set engine (%d)'%rc )
+			try:
+				yield eng
+			finally:
+				eng.pl.PL_set_engine( old.value, None )
+		finally:
+			self.__free.put( (handle, eng) )
+
+	def attached( self ):
+		"""Return PlThreadEngine of own engine of current thread. Engine
+		is created (PL_thread_attach_engine()) on first call in thread and
+		lives while detach() is not called in this thread"""
+		eng = getattr( self.__local, 'engine', None )
+		if eng is None:
+			eng = self.__local.engine = attach_thread( self.main )
+		return eng
+
+	def detach( self ):
+		"""Destroy own engine of current thread (see attached())"""
+		if getattr( self.__local, 'engine', None ) is not None:
+			self.__local.engine = None
+			self.main.pl.PL_thread_destroy_engine()
+
+	def close( self ):
+		"""Destroy engines of pool. All of them must be free"""
+		pl = self.main.pl
+		while self.__engines:
+			pl.PL_destroy_engine( self.__engines.pop() )
+		self.__free = queue.Queue()
+
+#-------------------------------------- asyncio ------------------------------------
+class PlAsyncExecutor:
+	"""Threads for PlEngine.aquery(). Each thread has own SWI-Prolog
+	engine (see attach_thread()) and runs one query at a time"""
+
+	def __init__( self, main, workers ):
+		if workers < 1:
+			raise ValueError( 'arg 2 must be positive' )
+		self.main = main
+		self.__jobs = queue.Queue()
+		self.__threads = []
+		for i in range( workers ):
+			th = threading.Thread( target=self.__worker )
+			th.daemon = True
+			th.start()
+			self.__threads.append( th )
+
+	def submit( self, job ):
+		"""Run job(engine) in one of threads"""
+		self.__jobs.put( job )
+
+	def __worker( self ):
+		eng = attach_thread( self.main )
+		try:
+			while True:
+				job = self.__jobs.get()
+				if job is None:
+					break
+				job( eng )
+		finally:
+			eng.pl.PL_thread_destroy_engine()
+
+	def shutdown( self ):
+		"""Stop threads after submitted jobs"""
+		for th in self.__threads:
+			self.__jobs.put( None )
+		self.__threads = []
+
+class PlAsyncQuery( object ):
+	"""Asynchronous iterator of query solutions (see PlEngine.aquery()).
+	Every __anext__() sends request to query thread and returns future
+	which is resolved by the thread with the next solution"""
+
+	def __init__( self, executor, goal, args, timeout=None ):
+		try:
+			import asyncio
+		except ImportError:
+			raise PlError( 'asyncio is not available' )
+		self.__asyncio = asyncio
+		self.__loop = asyncio.get_event_loop()
+		self.__executor = executor
+		self.__goal = goal
+		self.__args = args
+		self.__deadline = time.time() + timeout if timeout is not None else None
+		self.__requests = queue.Queue() # future of next solution or None to stop
+		self.__started = False
+		self.__finished = False
+
+	def __aiter__( self ):
+		return self
+
+	def __anext__( self ):
+		asyncio = self.__asyncio
+		fut = self.__loop.create_future()
+		if self.__finished:
+			fut.set_exception( StopAsyncIteration() )
+			return fut
+		if self.__deadline is not None:
+			remaining = self.__deadline - time.time()
+			if remaining <= 0:
+				self.close()
+				fut.set_exception( asyncio.TimeoutError() )
+				return fut
+			timer = self.__loop.call_later( remaining, self.__expire, fut )
+			fut.add_done_callback( lambda f: timer.cancel() )
+		fut.add_done_callback( self.__done )
+		if not self.__started:
+			self.__started = True
+			self.__executor.submit( _async_query_job( self.__loop, self.__requests,
+				self.__goal, self.__args ) )
+		self.__requests.put( fut )
+		return fut
+
+	def aclose( self ):
+		"""Cut the query, return awaitable"""
+		self.close()
+		fut = self.__loop.create_future()
+		fut.set_result( None )
+		return fut
+
+	def close( self ):
+		"""Cut the query (when its current step is finished)"""
+		if not self.__finished:
+			self.__finished = True
+			self.__requests.put( None )
+
+	def __expire( self, fut ):
+		if not fut.done():
+			fut.set_exception( self.__asyncio.TimeoutError() )
+
+	def __del__( self ):
+		# abandoned iterator releases its thread
+		self.close()
+
+	def __done( self, fut ):
+		if fut.cancelled() or fut.exception() is not None:
+			# cancelled, timed out or finished
+			self.close()
+
+def _resolve_future( fut, result=None, exc=None ):
+	"""Set result of asyncio future (in event loop thread)"""
+	if fut.done():
+		return
+	if exc is not None:
+		fut.set_exception( exc )
+	else:
+		fut.set_result( result )
+
+def _async_query_job( loop, requests, goal, args ):
+	"""Return job for PlAsyncExecutor: query loop which takes futures from
+	requests and resolves them with solutions. It does not refer to
+	PlAsyncQuery, so abandoned iterator can be collected (and closed)"""
+	def job( eng ):
+		call = loop.call_soon_threadsafe
+		with eng.frame():
+			solutions = eng.query( goal, *args, decode=True )
+			try:
+				while True:
+					fut = requests.get()
+					if fut is None:
+						break
+					if fut.done():
+						continue # cancelled or timed out, None follows
+					try:
+						sol = next( solutions )
+					except StopIteration:
+						call( _resolve_future, fut, None, StopAsyncIteration() )
+						break
+					except Exception as e:
+						call( _resolve_future, fut, None, e )
+						break
+					call( _resolve_future, fut, sol )
+			finally:
+				solutions.close()
+	return job
+
+#-------------------------------------- Processes ------------------------------------
+def _process_worker( args, kw, tasks, results ):
+	"""Main function of PlProcessPool worker: serve queries from tasks
+	queue until None. Task is marshal-ed (map_id, index, goal, args),
+	result is marshal-ed (map_id, index, ok, solutions or error text).
+	If PlEngine can not be created, error result has map_id None"""
+	try:
+		pleng = PlEngine( *args, **kw )
+	except Exception as e:
+		results.put( marshal.dumps( (None, None, False,
+			'worker can not start: %s: %s'%(type(e).__name__, e)) ) )
+		return
+	while True:
+		msg = tasks.get()
+		if msg is None:
+			break
+		map_id, index, goal, qargs = marshal.loads( msg )
+		try:
+			# term handles of each query are released
+			with pleng.frame():
+				sols = list( pleng.query( goal, *qargs, decode=True ) )
+			res = (map_id, index, True, sols)
+		except Exception as e:
+			res = (map_id, index, False, '%s: %s'%(type(e).__name__, e))
+		results.put( marshal.dumps( res ) )
+
+class PlProcessPool:
+	"""Pool of worker processes, each with own PlEngine created with the
+	same args and keywords (for example '-x', 'state' or consulted
+	files). It is for CPU-bound batch jobs: marshalling of each process
+	holds only its own GIL. Queries and answers are sent over pipes as
+	marshal-ed Python data (see PlEngine.put_term() and PlDecoder), so
+	arguments must be marshal-able. Process which creates pool should not
+	initialise SWI-Prolog itself before (workers may be forked). Failed
+	start of workers is raised by map():
+	    >>> pool = PlProcessPool( 1, state='/nonexistent/state' )
+	    >>> try:
+	    ...     list( pool.map( 'true', [()] ) )
+	    ... except PlError:
+	    ...     'failed'
+	    'failed'
+	    >>> pool.terminate()
+	"""
+	POLL_SECONDS = 1.0 # how often map() checks that workers are alive
+
+	def __init__( self, size, *args, **kw ):
+		if size < 1:
+			raise ValueError( 'arg 1 must be positive' )
+		import multiprocessing # slow import, only pools need it
+		self.__tasks = multiprocessing.Queue()
+		self.__results = multiprocessing.Queue()
+		self.__map_id = 0
+		self.__workers = []
+		for i in range( size ):
+			p = multiprocessing.Process( target=_process_worker,
+				args=(args, kw, self.__tasks, self.__results) )
+			p.daemon = True
+			p.start()
+			self.__workers.append( p )
+
+	def __len__( self ):
+		return len( self.__workers )
+
+	def map( self, goal, args_iterable, ordered=True, max_pending=None ):
+		"""Generator: run query goal (see PlEngine.query()) with each
+		tuple of arguments from args_iterable and yield list of its
+		solutions (tuples of decoded arguments). If ordered is False
+		yield (index of arguments, solutions) as soon as they are ready.
+		At most max_pending tasks (default is 2 per worker) are sent or
+		wait for yielding, so args_iterable is read lazily. Error of query
+		raises PlError, as well as error of worker start and exit of
+		worker process. Only one map() of pool can be iterated at a time:
+		results of abandoned map() are dropped"""
+		if max_pending is None:
+			max_pending = 2*len( self )
+		self.__map_id += 1
+		map_id = self.__map_id
+		args_iterable = iter( args_iterable )
+		sent = 0 # number of sent tasks
+		pending = 0 # sent, but result was not received
+		ready = {} # index -> solutions: received, but not yielded (ordered)
+		next_index = 0 # index of next yielded result (ordered)
+		exhausted = False
+		while True:
+			while not exhausted and pending + len( ready ) < max_pending:
+				try:
+					qargs = next( args_iterable )
+				except StopIteration:
+					exhausted = True
+					break
+				self.__tasks.put( marshal.dumps( (map_id, sent, goal, tuple(qargs)) ) )
+				sent += 1
+				pending += 1
+			if not pending:
+				break
+			try:
+				msg = self.__results.get( True, self.POLL_SECONDS )
+			except queue.Empty:
+				for p in self.__workers:
+					if not p.is_alive():
+						raise PlError( 'worker process exited (code %s)'%p.exitcode )
+				continue
+			res_id, index, ok, value = marshal.loads( msg )
+			if res_id is None:
+				raise PlError( value ) # worker did not start
+			if res_id != map_id:
+				continue # result of abandoned map()
+			pending -= 1
+			if not ok:
+				raise PlError( value )
+			if not ordered:
+				yield (index, value)
+				continue
+			ready[index] = value
+			while next_index in ready:
+				yield ready.pop( next_index )
+				next_index += 1
+
+	def close( self ):
+		"""Stop workers after all sent tasks"""
+		for p in self.__workers:
+			self.__tasks.put( None )
+		for p in self.__workers:
+			p.join()
+		self.__workers = []
+
+	def terminate( self ):
+		"""Stop workers immediately"""
+		for p in self.__workers:
+			p.terminate()
+		self.__workers = []
+
 def _test():
 	"""Test --------------------------------------------------------
+	Expected results are for SWI-Prolog 7 or later (findnsols/4,
+	PL_NIL and PL_LIST_PAIR term types)
 	>>> pleng = PlEngine()
 	>>> t = pleng.Term( 3 )
 	>>> t[0].pl_term-t[1].pl_term == t[1].pl_term - t[2].pl_term == -1
@@ -575,6 +3044,116 @@ def _test():
 	>>> a1 = t.get_atom()
 	>>> ut('PL_atom_chars:->char_p')(a1.pl_atom)
 	'hello'
+	>>> len( list( pleng.query( 'true' ) ) )
+	1
+	>>> len( list( pleng.query( 'fail' ) ) )
+	0
+	>>> t = pleng.to_term( [1, ('f', 'a', 2.5), {'k': None}, 2**70] )
+	>>> t.is_list()
+	True
+	>>> pleng.decode( t )
+	[1, ('f', 'a', 2.5), [('-', 'k', None)], 1180591620717411303424L]
+	>>> [x for x, l in pleng.query( 'lists:member', None, [1, 'a'], decode=True )]
+	[1, 'a']
+	>>> pleng.atom( 'hello' ).pl_atom == pleng.atoms['hello']
+	True
+	>>> pleng.functor( 'f', 2 ).pl_functor == pleng.functors[('f', 2)]
+	True
+	>>> pleng.atoms.stats()['hits'] > 0
+	True
+	>>> with pleng.frame() as fr:
+	...     t = pleng.to_term( ('point', 1, 2) )
+	...     fr.rewind()
+	...     t = pleng.to_term( ('point', 3, 4) )
+	>>> fr.pl_frame is None
+	True
+	>>> pleng.assert_many( 'edge', [(1, 2), (2, 3)] )['facts']
+	2
+	>>> pleng.assert_many( 'edge', [(3, 4), (4, 5)], bulk=True )['facts']
+	2
+	>>> [b for a, b in pleng.query( 'edge', 2, None, decode=True )]
+	[3]
+	>>> len( list( pleng.query( 'edge', None, None ) ) )
+	4
+	>>> t = pleng.to_term( ('f', 'a', [1, 2, 3]) )
+	>>> t.name_arity()
+	('f', 2)
+	>>> l = t.arg( 2, decode=False )
+	>>> l.length(), list( l.iter_list() )
+	(3, [1, 2, 3])
+	>>> r = pleng.record( [1, ('f', 'a')] )
+	>>> pleng.decode( pleng.recorded( r ) )
+	[1, ('f', 'a')]
+	>>> pleng.decode( pleng.recorded_external( pleng.record_external( ('g', 2.5) ) ) )
+	('g', 2.5)
+	>>> try:
+	...     pleng.assert_many( 'atom', [('x',)] )
+	... except PlPermissionError as e:
+	...     e.formal[0]
+	'permission_error'
+	>>> list( pleng.query( 'between', 1, 5, None, batch=2 ) )
+	[(1, 5, 1), (1, 5, 2), (1, 5, 3), (1, 5, 4), (1, 5, 5)]
+	>>> try:
+	...     list( pleng.query( 'atom_length', None, None ) )
+	... except PlInstantiationError as e:
+	...     e.formal
+	'instantiation_error'
+	>>> pleng.register_predicate( 'py_double', 2, lambda x, y: y.unify( 2*x.value ) )
+	>>> [y for x, y in pleng.query( 'py_double', 21, None, decode=True )]
+	[42]
+	>>> len( list( pleng.query( 'py_double', 1, 3 ) ) )
+	0
+	>>> closed = []
+	>>> def py_range( n, x ):
+	...     try:
+	...         for i in range( n.value ):
+	...             yield x.unify( i )
+	...     finally:
+	...         closed.append( n.value )
+	>>> pleng.register_predicate( 'py_range', 2, py_range, nondeterministic=True )
+	>>> [x for n, x in pleng.query( 'py_range', 3, None, decode=True )]
+	[0, 1, 2]
+	>>> [g for g, in pleng.query( 'once', ('py_range', 5, None), decode=True )]
+	[('py_range', 5, 0)]
+	>>> closed
+	[3, 5]
+	>>> pleng.register_predicate( 'py_div', 2, lambda x, y: y.unify( 1//x.value ) )
+	>>> try:
+	...     list( pleng.query( 'py_div', 0, None ) )
+	... except PlException as e:
+	...     e.formal[:2]
+	('python_error', 'ZeroDivisionError')
+	>>> member = pleng.prepare( 'lists:member(?, [a, b, c])' )
+	>>> [x for x, l in member( None, decode=True )]
+	['a', 'b', 'c']
+	>>> member.once( 'b' ), member.once( 'b' ), member.once( 'd' )
+	(('b', ['a', 'b', 'c']), ('b', ['a', 'b', 'c']), None)
+	>>> member.stats()['calls']
+	4
+	>>> length = pleng.prepare( 'length', 2 )
+	>>> data = [1, 2.5, 2**70]
+	>>> [n for l, n in length( data, None, decode=True )]
+	[3]
+	>>> [n for l, n in length( data, None, decode=True )]
+	[3]
+	>>> t = pleng.Term()
+	>>> pleng.put_array( t.pl_term, [1.5, 2.0, -3.25] )
+	>>> pleng.get_array( t.pl_term )
+	array('d', [1.5, 2.0, -3.25])
+	>>> pleng.put_array( t.pl_term, array.array( 'd', [0.1, 1e100] ), via_file=True )
+	>>> pleng.get_array( t.pl_term, via_file=True )
+	array('d', [0.1, 1e+100])
+	>>> pleng.put_array( t.pl_term, range( 5 ), 'l', via_file=True )
+	>>> pleng.get_array( t.pl_term, 'l', via_file=True )
+	array('l', [0, 1, 2, 3, 4])
+	>>> pleng.put_array( t.pl_term, [] )
+	>>> pleng.get_array( t.pl_term, via_file=True )
+	array('d')
+	>>> try:
+	...     pleng.put_array( t.pl_term, [1.0, float( 'inf' )], via_file=True )
+	... except ValueError:
+	...     'rejected'
+	'rejected'
 	"""
 	import doctest
 	doctest.testmod()